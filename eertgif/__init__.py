@@ -40,6 +40,7 @@ def main(global_config, **settings):
     config.add_route("eertgif:image", "/image/{tag}")
     config.add_route("eertgif:delete", "/delete/{tag}")
     config.add_route("eertgif:set_status", "/set_status/{tag}")
+    config.add_route("eertgif:progress", "/progress/{tag}")
 
     config.scan(".views")
     log.debug("Added routes.")
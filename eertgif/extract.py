@@ -4,10 +4,15 @@ from __future__ import annotations
 import copy
 import json
 import logging
+import multiprocessing
 import pickle
-import sys
+import re
 import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from math import ceil
 from threading import Lock
+from weakref import WeakValueDictionary
 from typing import List, Tuple
 
 
@@ -22,7 +27,15 @@ from pdfminer.layout import (
     LTRect,
     LTCurve,
 )
-from .graph import GraphFromEdges, Node, Edge
+from .graph import (
+    GraphFromEdges,
+    Node,
+    Edge,
+    component_skeleton,
+    nodes_from_skeleton,
+)
+from .phylo import LegendEngine, PhyloTree
+from .spatial import BoxIndex, CoordIndex
 from .safe_containers import UnprocessedRegion, SafeTextLine, SafeCurve
 from .util import (
     CurveShape,
@@ -30,7 +43,11 @@ from .util import (
     ExtractionConfig,
     Direction,
     AxisDir,
+    COORD_TOL,
+    IdOrderedSubset,
     orientation_to_direction,
+    parse_page_ranges,
+    win_safe_rename,
 )
 
 log = logging.getLogger("eertgif.extract")
@@ -94,6 +111,31 @@ def find_text_and_curves(
 
 _def_filter_shapes = {CurveShape.COMPLICATED, CurveShape.DOT}
 
+# number of analyze results kept by each ExtractionManager, see _AnalysisResult
+ANALYSIS_CACHE_SIZE = 4
+
+
+class _AnalysisResult(object):
+    """What analyze left in an ExtractionManager, so it can be restored later.
+
+    The graph and forest are shared with the manager (not copied), so the
+    manager must forget a result before it changes its graph in place.
+    """
+
+    def __init__(self, em):
+        self.graph, self.forest = em.graph, em.forest
+        self.trees = list(em.forest.trees)
+        self.legends = list(em.forest.legends)
+        self.best_tree, self.best_legend = em.best_tree, em.best_legend
+        self.display_mode = em.display_mode
+
+    def restore(self, em):
+        em.graph, em.forest = self.graph, self.forest
+        self.forest.trees[:] = self.trees
+        self.forest.legends[:] = self.legends
+        em.best_tree, em.best_legend = self.best_tree, self.best_legend
+        em.display_mode = self.display_mode
+
 
 class ExtractionManager(object):
     def __init__(self, unproc_page, extract_cfg=None):
@@ -118,10 +160,7 @@ class ExtractionManager(object):
         self._next_e_id = 1 + self.eertgif_id
         self.id_lock = Lock()
         self.container_bbox = unproc_page.container_bbox
-        self.text_lines = []
-        self.nontext_objs = []
-        self.trashed_text = []
-        self.trashed_nontext_objs = []
+        self._init_subsets()
         assert isinstance(self.container_bbox, tuple)
         assert len(self.container_bbox) == 4
         for el in self.container_bbox:
@@ -130,57 +169,76 @@ class ExtractionManager(object):
         self.forest = None
         self.best_tree = None
         self.best_legend = None
-        self._by_id = {}
+        self._legend_engine = LegendEngine()
+        self._analysis_cache = OrderedDict()
+        # ids of the region's text and curves, plus weak references to the
+        #   objects created by get_new_id, see get_by_id
+        self._raw_by_id = {}
+        for el in self._raw_text_lines + self._raw_nontext_objs:
+            self._raw_by_id[el.eertgif_id] = el
+        self._by_id = WeakValueDictionary()
         self.filter()
-        self._update_by_id_map()
+
+    def _init_subsets(self, text_lines=(), trashed_text=(), nontext=(), trashed=()):
+        """Creates the id-keyed text_lines, nontext_objs and trashed subsets."""
+        self.text_lines = IdOrderedSubset(self._raw_text_lines, text_lines)
+        self.trashed_text = self.text_lines.empty_like()
+        self.nontext_objs = IdOrderedSubset(self._raw_nontext_objs, nontext)
+        self.trashed_nontext_objs = self.nontext_objs.empty_like()
+        for obj in trashed_text:
+            self.trashed_text.add(obj)
+        for obj in trashed:
+            self.trashed_nontext_objs.add(obj)
+
+    def _subsets_for(self, obj):
+        """Returns the (active, trashed) subsets for the type of `obj`."""
+        if isinstance(obj, SafeCurve):
+            return self.nontext_objs, self.trashed_nontext_objs
+        return self.text_lines, self.trashed_text
 
     def set_extract_config(self, extract_cfg):
         trashed_ids = extract_cfg.get("force_trashed_ids", [])
         log.debug(f"force_trashed_ids = {trashed_ids}")
-        new_force_trashed = set()
-        all_trashed = set()
-        if trashed_ids:
-            self._update_by_id_map()
-            for tid in trashed_ids:
-                try:
-                    tid = int(tid)
-                except:
-                    pass
-                obj = self._by_id.get(tid)
-                if obj is None:
-                    raise RuntimeError(f"Unknown id to be trashed: {tid}")
-                log.debug(f"obj for {tid} = {obj}")
-                if isinstance(obj, Node):
-                    continue  # nodes are side effects of edge addition, so deleting a node
-                    #  won't change the next detect components
-                if isinstance(obj, Edge):
-                    obj = obj.curve
-                if isinstance(obj, SafeCurve):
-                    if obj in self.nontext_objs:
-                        self.nontext_objs.remove(obj)
-                        if obj not in self.trashed_nontext_objs:
-                            self.trashed_nontext_objs.append(obj)
-                            new_force_trashed.add(obj.eertgif_id)
-                    else:
-                        assert obj in self.trashed_nontext_objs
-                    all_trashed.add(obj.eertgif_id)
-                elif isinstance(obj, SafeTextLine):
-                    if obj in self.text_lines:
-                        self.text_lines.remove(obj)
-                        if obj not in self.trashed_text:
-                            self.trashed_text.append(obj)
-                            new_force_trashed.add(obj.eertgif_id)
-                    else:
-                        assert obj in self.trashed_text
-                    all_trashed.add(obj.eertgif_id)
-                else:
-                    raise RuntimeError(
-                        f"Unexpected attempt to trash element of type {type(obj)}"
-                    )
-        for auto_id in self.auto_trashed_ids:
-            if auto_id in all_trashed:
-                all_trashed.remove(auto_id)
-        self.force_trashed_ids = all_trashed
+        all_trashed = {}
+        for tid in trashed_ids:
+            try:
+                tid = int(tid)
+            except:
+                pass
+            obj = self.get_by_id(tid)
+            if obj is None:
+                raise RuntimeError(f"Unknown id to be trashed: {tid}")
+            log.debug("obj for %s = %s", tid, obj)
+            if isinstance(obj, Node):
+                continue  # nodes are side effects of edge addition, so deleting a node
+                #  won't change the next detect components
+            if isinstance(obj, Edge):
+                obj = obj.curve
+            if not isinstance(obj, (SafeCurve, SafeTextLine)):
+                raise RuntimeError(
+                    f"Unexpected attempt to trash element of type {type(obj)}"
+                )
+            all_trashed[obj.eertgif_id] = obj
+        # Only touch the objects whose status differs from the last config
+        prev_trashed = self.force_trashed_ids
+        for obj_id, obj in all_trashed.items():
+            if obj_id in prev_trashed:
+                continue
+            active, trashed = self._subsets_for(obj)
+            if obj in active:
+                active.discard(obj)
+                trashed.add(obj)
+            else:
+                assert obj in trashed
+        for obj_id in prev_trashed:
+            if obj_id in all_trashed or obj_id in self.auto_trashed_ids:
+                continue
+            obj = self.trashed_nontext_objs.get(obj_id) or self.trashed_text.get(obj_id)
+            if obj is not None:
+                active, trashed = self._subsets_for(obj)
+                trashed.discard(obj)
+                active.add(obj)
+        self.force_trashed_ids = set(all_trashed.keys()) - self.auto_trashed_ids
         extract_cfg = ExtractionConfig(extract_cfg, self._cfg)
         for k in ExtractionConfig.all_keys:
             if k in extract_cfg:
@@ -268,42 +326,43 @@ class ExtractionManager(object):
             pairings = self.create_pairings()
         return get_svg_str(obj_container=self, pairings=pairings)
 
-    def _update_by_id_map(self):
-        m = {}
-        for top_list in [
-            self._raw_text_lines,
-            self._raw_nontext_objs,
-            [self.graph, self.forest],
-        ]:
-            for el in top_list:
-                if el is not None:
-                    m[el.eertgif_id] = el
+    def _index_unpickled_objects(self):
+        """Fills the id maps with the raw objects and everything reachable from the forest.
+
+        Needed once after unpickling, as weak references are not pickled.
+        """
+        raw = {}
+        for el in self._raw_text_lines:
+            raw[el.eertgif_id] = el
+        for el in self._raw_nontext_objs:
+            raw[el.eertgif_id] = el
+        self._raw_by_id = raw
+        m = self._by_id
+        for el in [self.graph, self.forest]:
+            if el is not None:
+                m.setdefault(el.eertgif_id, el)
         if self.graph is not None:
-            m[self.graph.nodes.eertgif_id] = self.graph.nodes
+            m.setdefault(self.graph.nodes.eertgif_id, self.graph.nodes)
+            for nd in self.graph.iter_nodes():
+                m.setdefault(nd.eertgif_id, nd)
+            for e in self.graph.edges:
+                m.setdefault(e.eertgif_id, e)
         if self.forest is not None:
             f = self.forest
-            for c in f.components:
-                # record all the nodes and edges
-                for nd in c:
-                    m[nd.eertgif_id] = nd
-                    for e in nd.edges:
-                        m[e.eertgif_id] = e
-                # record all the PhyloTrees
-                for t in f.trees:
-                    if t is None:
-                        continue
-                    m[t.eertgif_id] = t
-                    pma = t.pma
-                    if pma:
-                        m[pma.eertgif_id] = pma
-                        if pma.phy_ctx:
-                            m[pma.phy_ctx.eertgif_id] = pma.phy_ctx
-                    for phynd in t.post_order():
-                        m[phynd.eertgif_id] = phynd
-                for leg in f.legends:
-                    if leg is not None:
-                        m[leg.eertgif_id] = leg
-        self._by_id = m
+            for t in f.trees:
+                if t is None:
+                    continue
+                m.setdefault(t.eertgif_id, t)
+                pma = t.pma
+                if pma:
+                    m.setdefault(pma.eertgif_id, pma)
+                    if pma.phy_ctx:
+                        m.setdefault(pma.phy_ctx.eertgif_id, pma.phy_ctx)
+                for phynd in t.post_order():
+                    m.setdefault(phynd.eertgif_id, phynd)
+            for leg in f.legends:
+                if leg is not None:
+                    m.setdefault(leg.eertgif_id, leg)
 
     @staticmethod
     def unpickle(in_stream):
@@ -314,25 +373,62 @@ class ExtractionManager(object):
 
     def post_unpickle(self):
         self.id_lock = Lock()
-        self._update_by_id_map()
+        # filled by get_by_id when first needed
+        self._raw_by_id = None
+        self._by_id = WeakValueDictionary()
+        self._legend_engine = LegendEngine()
+        self._analysis_cache = OrderedDict()
+        if isinstance(self.text_lines, list):
+            # pickled when these were stored as lists
+            self._init_subsets(
+                self.text_lines,
+                self.trashed_text,
+                self.nontext_objs,
+                self.trashed_nontext_objs,
+            )
+
+    # recreated by post_unpickle, rather than pickled
+    _unpickled_attrs = (
+        "_by_id",
+        "_raw_by_id",
+        "id_lock",
+        "_legend_engine",
+        "_analysis_cache",
+    )
 
     def pickle(self, out_stream):
-        d = self._by_id
-        lock = self.id_lock
+        saved = [(k, getattr(self, k)) for k in self._unpickled_attrs]
         try:
-            self._by_id = {}
-            self.id_lock = None
+            for k, v in saved:
+                setattr(self, k, None)
             pickle.dump(self, out_stream, protocol=pickle.HIGHEST_PROTOCOL)
         finally:
-            self._by_id = d
-            self.id_lock = lock
+            for k, v in saved:
+                setattr(self, k, v)
 
-    def get_new_id(self):
+    def get_new_id(self, obj=None):
+        """Returns a new id, and records `obj` (if given) as its owner for get_by_id."""
         with self.id_lock:
             i = self._next_e_id
             self._next_e_id += 1
+            if obj is not None:
+                self._by_id[i] = obj
         return i
 
+    def get_by_id(self, eertgif_id):
+        """Returns the object with `eertgif_id` or None.
+
+        Objects created since this manager was made or unpickled are found
+        through the weak references recorded by get_new_id. The objects of an
+        unpickled manager are only indexed the first time they are needed.
+        """
+        if self._raw_by_id is None:
+            self._index_unpickled_objects()
+        obj = self._raw_by_id.get(eertgif_id)
+        if obj is None:
+            obj = self._by_id.get(eertgif_id)
+        return obj
+
     def filter(self):
         auto_trashed_ids = set()
         tl = []
@@ -355,45 +451,65 @@ class ExtractionManager(object):
                 tn.append(obj)
             else:
                 no.append(obj)
-        changed = False
-        if tl != self.text_lines:
-            self.text_lines[:] = tl
-            changed = True
-        if ttl != self.trashed_text:
-            self.trashed_text[:] = ttl
-            changed = True
-        if no != self.nontext_objs:
-            changed = True
-            self.nontext_objs[:] = no
-        if tn != self.trashed_nontext_objs:
-            changed = True
-            self.trashed_nontext_objs[:] = tn
+        changed = self.text_lines.set_members(tl)
+        changed = self.trashed_text.set_members(ttl) or changed
+        changed = self.nontext_objs.set_members(no) or changed
+        changed = self.trashed_nontext_objs.set_members(tn) or changed
         if auto_trashed_ids != self.auto_trashed_ids:
             self.auto_trashed_ids.clear()
             self.auto_trashed_ids.update(auto_trashed_ids)
             changed = True
         return changed
 
-    def _new_graph(self):
+    def _update_graph(self, node_merge_tol, rect_merge_cfg) -> bool:
+        """Brings the current graph up to date with nontext_objs, if possible.
+
+        Curves that have been trashed since the graph was built are removed,
+        and restored curves are added. Returns False if a new graph is needed
+        because there is no graph, the tolerance differs, or rect-shape
+        joins have been forced into it that do not match `rect_merge_cfg`.
+        """
+        g = self.graph
+        if g is None or g.tol != node_merge_tol:
+            return False
+        curves = {c.eertgif_id: c for c in self.nontext_objs}
+        removed = [i for i in g.iter_curve_ids() if i not in curves]
+        added = [c for i, c in curves.items() if not g.has_curve(i)]
+        if g.rect_merge_cfg is not None:
+            if removed or added or g.rect_merge_cfg != rect_merge_cfg:
+                return False
+        if removed or added:
+            self._forget_analyses_of(g)
+        if removed:
+            g.remove_curves(removed)
+        for curve in added:
+            g.add_curve(curve)
+        if removed or added:
+            log.debug(
+                f"graph updated, {len(removed)} curves removed and {len(added)} added"
+            )
+        return True
+
+    def _new_graph(self, node_merge_tol=None):
         """
         Caller must update_map."""
-        self.graph = GraphFromEdges(self, node_merge_tol=self.node_merge_tol)
+        if node_merge_tol is None:
+            node_merge_tol = self.node_merge_tol
+        self.graph = GraphFromEdges(self, node_merge_tol=node_merge_tol)
         for curve in self.nontext_objs:
             self.graph.add_curve(curve)
         log.debug(
-            f"graph with {len(self.graph.nodes._all_nodes)} nodes and {len(self.graph.edges)} edges created."
+            f"graph with {len(self.graph.nodes)} nodes and {len(self.graph.edges)} edges created."
         )
 
     def merge_component_using_rect_shape_joins(self):
         mergeable = self._find_mergeable_components_rect()
         for tup in mergeable:
             e1, most_extreme, e2, coord = tup[2:]
-            if e1.component_idx == e2.component_idx:
+            # component_idx is stale during the merges, so ask the graph
+            if self.graph.same_component(e1.nd1, e2.nd1):
                 continue
-            c1_idx = e1.component_idx
-            c2_idx = e2.component_idx
             self.graph.force_merge(e1, most_extreme, e2, coord)
-            self.forest._post_merge_hook(c1_idx, c2_idx)
 
     def _find_mergeable_components_rect(self):
         target_shapes, ext_point_dir = None, None
@@ -417,30 +533,36 @@ class ExtractionManager(object):
             ext_point_dir = Direction.NORTH
             base_axis = AxisDir.HORIZONTAL
 
-        edges = self.graph.edges
+        graph = self.graph
+        edges = graph.edges
+        # only the edges whose base axis is within nm_tol of an extreme point
+        #   can contain it. Like axis_contains, this compares x coordinates.
+        #   The slack guards against rounding at the boundary, axis_contains
+        #   does the exact test.
+        base_coords = ((e.base_axis_coord(base_axis), e) for e in edges)
+        axis_index = CoordIndex(ce for ce in base_coords if ce[0] is not None)
+        search_tol = nm_tol + COORD_TOL
         mergeable = []
         for e1 in edges:
-            comp_idx = e1.component_idx
             most_extreme = e1.most_extreme_vis_point(ext_point_dir)
-            for e2 in edges:
+            for e2 in axis_index.within(most_extreme[0], search_tol):
                 if e2 is e1:
                     continue
-                if e2.component_idx == comp_idx:
+                # asks the graph, as component_idx is only refreshed when
+                #   the forest's components are read
+                if graph.same_component(e1.nd1, e2.nd1):
                     continue
-
                 contains, coord, dist = e2.axis_contains(
                     base_axis, most_extreme, nm_tol
                 )
-
                 if contains:
                     log.debug(
-                        f"  mergeable {(dist, e1.eertgif_id, e1, most_extreme, e2, coord)}"
+                        "  mergeable %s",
+                        (dist, e1.eertgif_id, e1, most_extreme, e2, coord),
                     )
                     mergeable.append((dist, e1.eertgif_id, e1, most_extreme, e2, coord))
-                else:
-                    log.debug(f"  unmergeable {e1} and {e2}")
-
-        mergeable.sort()
+        # the ids break ties, Edge objects are not orderable
+        mergeable.sort(key=lambda tup: (tup[0], tup[1], tup[4].eertgif_id))
         return mergeable
 
     def clear_trees(self):
@@ -449,98 +571,151 @@ class ExtractionManager(object):
         if self.forest:
             self.forest.clear_trees()
 
-    def detect_components(
-        self, node_merge_tol=None, suppress_update_map=False, suppress_filter=False
-    ):
+    def detect_components(self, node_merge_tol=None, suppress_filter=False):
         self.clear_trees()
         if not suppress_filter:
-            filter_changed = self.filter()
-        else:
-            filter_changed = False
-        # id_list = [i.eertgif_id for i in self.text_lines]
-        # assert 136 not in id_list
-        # assert 126 not in id_list
-        # assert 123 not in id_list
-
+            self.filter()
         node_merge_tol = (
             node_merge_tol if node_merge_tol is not None else self.node_merge_tol
         )
-        new_graph = (
-            True
-            or (self.graph is None)
-            or (self.graph.tol != node_merge_tol)
-            or filter_changed
-        )
+        if self.is_rect_shape:
+            rect_merge_cfg = (self.orientation, self._cfg["rect_base_intercept_tol"])
+        else:
+            rect_merge_cfg = None
+        new_graph = not self._update_graph(node_merge_tol, rect_merge_cfg)
         if new_graph:
-            self._new_graph()
-        new_forest = True
-        self.forest = self.graph.build_forest()
+            self._new_graph(node_merge_tol)
+        new_forest = (
+            new_graph or self.forest is None or self.forest.graph is not self.graph
+        )
+        if new_forest:
+            self.forest = self.graph.build_forest()
         log.debug(f"{len(self.forest.components)} components detected")
-        if self.is_rect_shape:
-            rbit = self._cfg["rect_base_intercept_tol"]
-            if (
-                self.forest.rect_base_intercept_tol is None
-                or self.forest.rect_base_intercept_tol != rbit
-            ):
-                self.merge_component_using_rect_shape_joins()
-
-        if (new_forest or new_graph) and not suppress_update_map:
-            self._update_by_id_map()
+        if (rect_merge_cfg is not None) and (
+            self.graph.rect_merge_cfg != rect_merge_cfg
+        ):
+            self._forget_analyses_of(self.graph)
+            self.merge_component_using_rect_shape_joins()
+            self.graph.rect_merge_cfg = rect_merge_cfg
+            self.forest.rect_base_intercept_tol = rect_merge_cfg[1]
         if self.display_mode == DisplayMode.CURVES_AND_TEXT:
             self.display_mode = DisplayMode.COMPONENTS
 
-    def extract_trees(self):
-        return self.analyze()
+    def extract_trees(self, num_workers=None):
+        return self.analyze(num_workers=num_workers)
+
+    def _analysis_key(self) -> tuple:
+        """Returns a fingerprint of the settings that affect the result of analyze."""
+        if self.is_rect_shape:
+            rect_tol = self._cfg["rect_base_intercept_tol"]
+        else:
+            rect_tol = None
+        return (
+            frozenset(self.force_trashed_ids),
+            self.node_merge_tol,
+            self.orientation,
+            self.is_rect_shape,
+            rect_tol,
+        )
 
-    def analyze(self):
-        # build forest, but don't update map, as we'll do that after the trees are made
-        self.detect_components(suppress_update_map=True)
-        extra_lines = set(self.text_lines)
-        best_tree, best_score = None, float("inf")
+    def _forget_analyses_of(self, graph):
+        """Drops the cached analyze results that use `graph`, before it is changed."""
+        stale = [k for k, v in self._analysis_cache.items() if v.graph is graph]
+        for k in stale:
+            del self._analysis_cache[k]
 
-        # id_list = [i.eertgif_id for i in self.text_lines]
-        # assert 136 not in id_list
-        # assert 126 not in id_list
-        # assert 123 not in id_list
+    def analyze(self, num_workers=None):
+        """Interprets the components with more than 4 nodes as trees and keeps the best.
 
-        for n, c in enumerate(self.forest.components):
+        Each component is only offered the text near it. If `num_workers`
+        is greater than 1, the candidate components are scored in that many
+        worker processes, and only the best is interpreted again here.
+
+        The results for the last few settings are kept, so switching back
+        to earlier settings does not redo the analysis.
+        """
+        key = self._analysis_key()
+        prev = self._analysis_cache.get(key)
+        if prev is not None:
+            log.debug("reusing the analysis of these settings")
+            self._analysis_cache.move_to_end(key)
+            self.filter()
+            prev.restore(self)
+            return self.best_tree
+        self._analyze(num_workers)
+        self._analysis_cache[key] = _AnalysisResult(self)
+        while len(self._analysis_cache) > ANALYSIS_CACHE_SIZE:
+            self._analysis_cache.popitem(last=False)
+        return self.best_tree
+
+    def _analyze(self, num_workers):
+        self.detect_components()
+        forest, tip_dir = self.forest, self.orientation_as_direction
+        text_index = BoxIndex((i.bbox, i) for i in self.text_lines)
+        candidates = []
+        for n, c in enumerate(forest.components):
             if len(c) > 4:
-                tree = self.forest.interpret_as_tree(
-                    n, self.text_lines, self.orientation_as_direction
-                )
+                candidates.append((n, forest.text_near_component(n, text_index)))
+        best_tree, best_score, best_text = None, float("inf"), None
+        if num_workers is not None and num_workers > 1 and len(candidates) > 1:
+            scores = self._score_trees_in_workers(candidates, num_workers)
+            best_idx = None
+            for (n, near_text), score in zip(candidates, scores):
+                if score < best_score:
+                    best_score, best_idx, best_text = score, n, near_text
+            if best_idx is not None:
+                best_tree = forest.interpret_as_tree(best_idx, best_text, tip_dir)
+        else:
+            for n, near_text in candidates:
+                tree = forest.interpret_as_tree(n, near_text, tip_dir)
                 score = tree.score
                 if score < best_score:
-                    best_score = score
-                    best_tree = tree
-                extra_lines = extra_lines.difference(tree.used_text)
+                    best_score, best_tree, best_text = score, tree, near_text
 
         self.best_tree = best_tree
         self.best_legend = None
         if not best_tree:
-            self._update_by_id_map()
             return None
         self.display_mode = DisplayMode.PHYLO
-        pma = best_tree.attempt
-        best_legend, best_leg_score = None, float("inf")
-        for n, c in enumerate(self.forest.components):
-            if len(c) <= 4:
-                legend = self.forest.interpret_as_legend(n, pma.unused_text)
-                if (legend is not None) and (legend.score < best_leg_score):
-                    best_leg_score = legend.score
-                    best_legend = legend
-        self.best_legend = best_legend
+        offered = set(best_text)
+        best_tree.unoffered_text = [i for i in self.text_lines if i not in offered]
+        self.best_legend = self._legend_engine.best_legend(
+            forest, best_tree.unused_text
+        )
         best_tree.clean_for_export()
-        self._update_by_id_map()
         return self.best_tree
 
+    def _score_trees_in_workers(self, candidates, num_workers) -> List[float]:
+        """Returns the tree score of each (component index, text lines) candidate.
+
+        Only a skeleton of each component (without curves) and its text is
+        sent to the workers, and nothing they build is kept.
+        """
+        comps = self.forest.components
+        # in id order, so the ids given in the workers break ties the same way
+        skeletons = [
+            component_skeleton(sorted(comps[n], key=lambda nd: nd.eertgif_id))
+            for n, near_text in candidates
+        ]
+        text_lists = [near_text for n, near_text in candidates]
+        tip_dirs = [self.orientation_as_direction] * len(candidates)
+        # spawn, rather than fork, because the server calls this from a worker thread
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            max_workers=min(num_workers, len(candidates)), mp_context=ctx
+        ) as executor:
+            return list(
+                executor.map(_score_tree_skeleton, skeletons, text_lists, tip_dirs)
+            )
+
     @property
     def edge_len_scaler(self):
         if self.best_legend is not None:
             return self.best_legend.edge_len_scaler
         return None
 
-    def analyze_print_and_return_tree(self):
-        tree = self.analyze()
+    def analyze_print_and_return_tree(self, num_workers=None):
+        tree = self.analyze(num_workers=num_workers)
         if tree is None:
             log.debug("tree from analyze is None")
         else:
@@ -548,15 +723,132 @@ class ExtractionManager(object):
         return tree
 
 
-def print_and_return_tree(extract_cfg, unproc_page):
+class _WorkerIdGen(object):
+    """Numbers the objects built by _score_tree_skeleton, like an ExtractionManager.
+
+    The tree building breaks ties between tips at the same location by id.
+    """
+
+    def __init__(self):
+        self._next_e_id = 1
+
+    def get_new_id(self, obj=None):
+        i = self._next_e_id
+        self._next_e_id += 1
+        return i
+
+
+def _score_tree_skeleton(skeleton, text_lines, tip_dir) -> float:
+    """Returns the score of a component_skeleton interpreted as a tree (in a worker)."""
+    id_gen = _WorkerIdGen()
+    nodes = nodes_from_skeleton(*skeleton, id_gen=id_gen)
+    tree = PhyloTree(
+        connected_nodes=nodes, text_lines=text_lines, id_gen=id_gen, tip_dir=tip_dir
+    )
+    return tree.score
+
+
+def print_and_return_tree(extract_cfg, unproc_page, num_workers=None):
     extract_mgr = ExtractionManager(unproc_page, extract_cfg=extract_cfg)
-    return extract_mgr.analyze_print_and_return_tree()
+    return extract_mgr.analyze_print_and_return_tree(num_workers=num_workers)
+
+
+# Operators that construct paths (moveto, lineto, curveto variants and rectangle).
+#   The lookbehind/lookahead keep us from matching operators that merely
+#   start or end with these letters.
+_path_op_pat = re.compile(rb"(?:(?<=[\s\])>}])|^)(?:re|[mlcvy])(?=[\s\[(/<%]|$)")
+_do_op_pat = re.compile(rb"/([^\s/\[\]()<>{}%]+)\s+Do(?=[\s\[(/<%]|$)")
+_inline_image_pat = re.compile(rb"(?:(?<=\s)|^)BI(?=\s)")
+
+
+class PageScan(object):
+    """Cheap summary of the content stream of a page.
+
+    Used to skip pdfminer interpretation and layout analysis of pages
+    that could not hold a tree drawn with vector graphics.
+    """
+
+    def __init__(self, page_num, num_path_ops=0, num_form_xobjects=0, num_images=0):
+        self.page_num = page_num
+        self.num_path_ops = num_path_ops
+        self.num_form_xobjects = num_form_xobjects
+        self.num_images = num_images
+        self.interpreted = None
+
+    @property
+    def could_have_tree(self):
+        # form XObjects can hold paths, so we can't rule them out without
+        #   the full interpretation.
+        return self.num_path_ops > 0 or self.num_form_xobjects > 0
+
+    def as_dict(self):
+        return {
+            "page_num": self.page_num,
+            "num_path_ops": self.num_path_ops,
+            "num_form_xobjects": self.num_form_xobjects,
+            "num_images": self.num_images,
+            "interpreted": self.interpreted,
+        }
+
+
+def scan_page(page, page_num) -> PageScan:
+    """Counts path-construction operators and XObjects in a PDFPage.
+
+    Does not interpret the page, so text strings that happen to look like
+    operators can inflate the counts. That errs on the side of a full parse.
+    """
+    from pdfminer.pdftypes import resolve1
+    from pdfminer.psparser import LIT
+
+    scan = PageScan(page_num)
+    try:
+        data = b"\n".join(resolve1(c).get_data() for c in page.contents)
+    except Exception:
+        log.exception(f"could not read the content stream of page {page_num}")
+        scan.num_form_xobjects = 1  # force interpretation
+        return scan
+    scan.num_path_ops = sum(1 for _ in _path_op_pat.finditer(data))
+    scan.num_images = sum(1 for _ in _inline_image_pat.finditer(data))
+    xobjects = resolve1(page.resources.get("XObject", {})) or {}
+    for m in _do_op_pat.finditer(data):
+        xobj = resolve1(xobjects.get(m.group(1).decode("latin-1")))
+        subtype = None if xobj is None else xobj.get("Subtype")
+        if subtype is LIT("Image"):
+            scan.num_images += 1
+        else:
+            scan.num_form_xobjects += 1
+    return scan
+
 
+def _prescan_page_filter(page_scans, keep_image_pages=False):
+    """Returns a `page_filter` for my_extract_pages that scans each page.
 
-def my_extract_pages(pdf_file, page_numbers=None):
-    """Extract and yield (LTPage, interpreter, device, resource_mgr) tuples
+    The PageScan for every page is appended to `page_scans`.
+    Pages with images (but no paths) are interpreted if `keep_image_pages`
+    is True, so that their images can be exported.
+    """
+
+    def page_filter(page_num, page):
+        scan = scan_page(page, page_num)
+        scan.interpreted = scan.could_have_tree or (
+            keep_image_pages and scan.num_images > 0
+        )
+        page_scans.append(scan)
+        if not scan.interpreted:
+            log.debug(f"pre-scan skipping page {page_num}: {scan.as_dict()}")
+        return scan.interpreted
+
+    return page_filter
+
+
+def my_extract_pages(pdf_file, page_numbers=None, page_filter=None):
+    """Extract and yield (LTPage, interpreter, device, resource_mgr, page_num) tuples
 
     Tweak of pdfminer.six version to the PDFResourceManagerToo
+    `page_num` is the 0-based index of the page in the document (even if
+    `page_numbers` restricts the pages that are processed).
+    If `page_filter` is not None, it is called with (page_num, PDFPage) and
+    pages for which it returns False are not interpreted.
     """
     laparams = LAParams()
     maxpages = 0
@@ -577,17 +869,50 @@ def my_extract_pages(pdf_file, page_numbers=None):
         resource_manager = PDFResourceManager(caching=caching)
         device = PDFPageAggregator(resource_manager, laparams=laparams)
         interpreter = PDFPageInterpreter(resource_manager, device)
-        for page in PDFPage.get_pages(
-            fp, page_numbers, maxpages=maxpages, password=password, caching=caching
+        for page_num, page in enumerate(
+            PDFPage.get_pages(
+                fp, None, maxpages=maxpages, password=password, caching=caching
+            )
         ):
+            if page_numbers and (page_num not in page_numbers):
+                continue
+            if page_filter is not None and not page_filter(page_num, page):
+                continue
             interpreter.process_page(page)
             layout = device.get_result()
-            yield layout, interpreter, device, resource_manager
+            yield layout, interpreter, device, resource_manager, page_num
+
+
+def count_pages(pdf_file):
+    """Returns the number of pages in `pdf_file` without interpreting them."""
+    from pdfminer.high_level import open_filename, cast, BinaryIO, PDFPage
+
+    with open_filename(pdf_file, "rb") as fp:
+        fp = cast(BinaryIO, fp)
+        return sum(1 for _ in PDFPage.get_pages(fp))
+
+
+def ingest_settings(params=None, prescan=True, page_numbers=None) -> dict:
+    """Returns a JSON-serializable summary of the settings that affect the regions
+    produced by iter_regions_unprocessed (used to key cached parses).
+    """
+    if params is None:
+        params = LAParams()
+    return {
+        "laparams": {k: v for k, v in sorted(vars(params).items())},
+        "prescan": bool(prescan),
+        "pages": sorted(page_numbers) if page_numbers else None,
+    }
 
 
 def _process_figures(
-    ur, image_paths, figures, params, image_writer, pdf_interpret, n, prev_fn
+    image_paths, figures, params, image_writer, pdf_interpret, n, prev_fn
 ):
+    """Generator of the UnprocessedRegion objects with content in `figures`.
+
+    Returns (via StopIteration, so use `yield from`) the list of subfigures
+    and the last subpage number used.
+    """
     subfigures = []
     subpage_n = prev_fn
     for fn, fig in enumerate(figures):
@@ -599,44 +924,331 @@ def _process_figures(
         if unproc_page.has_content:
             unproc_page.page_num = n
             unproc_page.subpage_num = fn + subpage_n
-            ur.append(unproc_page)
             log.debug(
                 f"Added UnprocessedRegion {unproc_page.tag} n={n} subpage_n={subpage_n} fn={fn} prev_fn={prev_fn}"
             )
+            yield unproc_page
         subfigures.extend(subfig_list)
 
     return subfigures, subpage_n
 
 
-def get_regions_unprocessed(filepath, params=None, image_writer=None):
-    ur, image_paths = [], []
-    for n, pag_tup in enumerate(my_extract_pages(filepath)):
-        page_layout = pag_tup[0]
-        pdf_interpret = pag_tup[1]
-        figures = [page_layout]
-        prev_fn = -1  # pre-increment will cause first to be 0
-        subfigures = []
-        while figures:
-            subfigures, prev_fn = _process_figures(
-                ur,
-                image_paths,
-                figures,
-                params,
-                image_writer,
-                pdf_interpret,
-                n,
-                prev_fn,
-            )
-            figures = subfigures
+def _process_page(image_paths, pag_tup, params, image_writer):
+    """Generator of the UnprocessedRegion objects for one page (and its figures)."""
+    page_layout = pag_tup[0]
+    pdf_interpret = pag_tup[1]
+    n = pag_tup[-1]
+    figures = [page_layout]
+    prev_fn = -1  # pre-increment will cause first to be 0
+    while figures:
+        figures, prev_fn = yield from _process_figures(
+            image_paths,
+            figures,
+            params,
+            image_writer,
+            pdf_interpret,
+            n,
+            prev_fn,
+        )
+
+
+class LazyImageWriter(object):
+    """Stand-in for pdfminer's ImageWriter that defers decoding images.
+
+    export_image only records the object id of the image's stream (and its
+    name and bbox) in `image_refs`, and returns an id for the image. The
+    image can be written later with export_image_ref. Inline images do not
+    have an object id, so they are exported to `outdir` immediately.
+    """
+
+    def __init__(self, outdir):
+        self.outdir = outdir
+        self.image_refs = {}
+        self._image_writer = None
+
+    def export_image(self, image) -> str:
+        objid = getattr(image.stream, "objid", None)
+        if objid is None:
+            if self._image_writer is None:
+                self._image_writer = ImageWriter(self.outdir)
+            return self._image_writer.export_image(image)
+        # an XObject drawn more than once is only recorded (and exported) once.
+        img_id = f"obj{objid}"
+        if img_id not in self.image_refs:
+            self.image_refs[img_id] = {
+                "objid": objid,
+                "name": image.name,
+                "bbox": list(image.bbox),
+            }
+        return img_id
+
+
+def export_image_ref(pdf_file, image_ref, image_writer) -> str:
+    """Decodes the image recorded by LazyImageWriter as `image_ref` from `pdf_file`.
+
+    Returns the name of the file written by `image_writer`.
+    """
+    from pdfminer.pdfparser import PDFParser
+    from pdfminer.pdfdocument import PDFDocument
+    from pdfminer.pdftypes import PDFStream
+
+    with open(pdf_file, "rb") as fp:
+        doc = PDFDocument(PDFParser(fp))
+        stream = doc.getobj(image_ref["objid"])
+        if not isinstance(stream, PDFStream):
+            raise RuntimeError(f"Object {image_ref['objid']} is not an image stream")
+        image = LTImage(image_ref["name"], stream, tuple(image_ref["bbox"]))
+        return image_writer.export_image(image)
+
+
+# Each parallel ingest worker gets about this many contiguous page ranges.
+_CHUNKS_PER_WORKER = 2
+
+
+def _page_filter(prescan, page_scans, image_writer):
+    if not prescan:
+        return None
+    return _prescan_page_filter(page_scans, keep_image_pages=image_writer is not None)
+
+
+def _progress_page_filter(page_filter, progress):
+    """Wraps `page_filter` so that `progress` is called for the pages it skips."""
+    if progress is None:
+        return page_filter
+
+    def progress_filter(page_num, page):
+        keep = page_filter is None or page_filter(page_num, page)
+        if not keep:
+            progress(page_num)
+        return keep
+
+    return progress_filter
+
+
+# set in each parallel ingest worker by _init_chunk_worker
+_stop_event = None
+
+
+def _init_chunk_worker(stop_event):
+    global _stop_event
+    _stop_event = stop_event
+
+
+def _process_page_chunk(filepath, page_numbers, params, image_writer, prescan):
+    """Worker for the parallel mode of iter_regions_unprocessed.
+
+    Runs in a separate process (with its own pdfminer resource manager), so the
+    returned UnprocessedRegion list, image names and PageScan list must be picklable.
+    Stops after the current page if the parse has been abandoned (the
+    results are then discarded).
+    """
+    ur, image_paths, page_scans = [], [], []
+    page_filter = _page_filter(prescan, page_scans, image_writer)
+    for pag_tup in my_extract_pages(
+        filepath, page_numbers=page_numbers, page_filter=page_filter
+    ):
+        ur.extend(_process_page(image_paths, pag_tup, params, image_writer))
+        if _stop_event is not None and _stop_event.is_set():
+            break
+    image_refs = getattr(image_writer, "image_refs", None)
+    return ur, image_paths, page_scans, image_refs
+
+
+def _chunk_image_writer(image_writer, chunk_idx):
+    """ImageWriter for one worker, so that workers do not race on image names."""
+    if image_writer is None:
+        return None
+    chunk_dir = os.path.join(image_writer.outdir, f".chunk{chunk_idx}")
+    return type(image_writer)(chunk_dir)
+
+
+def _merge_chunk_images(image_writer, chunk_writer, names, chunk_refs=None):
+    """Moves images written by `chunk_writer` into the outdir of `image_writer`.
+
+    Names of images that a LazyImageWriter only recorded (the keys of
+    `chunk_refs`) are kept, and their references added to `image_writer`.
+    Returns the list of names (relative to the outdir of `image_writer`).
+    """
+    merged = []
+    for name in names:
+        if chunk_refs and name in chunk_refs:
+            image_writer.image_refs.setdefault(name, chunk_refs[name])
+            merged.append(name)
+            continue
+        stem, ext = os.path.splitext(name)
+        dest_name, img_index = name, 0
+        while os.path.exists(os.path.join(image_writer.outdir, dest_name)):
+            dest_name = f"{stem}.{img_index}{ext}"
+            img_index += 1
+        win_safe_rename(
+            os.path.join(chunk_writer.outdir, name),
+            os.path.join(image_writer.outdir, dest_name),
+        )
+        merged.append(dest_name)
+    try:
+        os.rmdir(chunk_writer.outdir)
+    except OSError:
+        log.debug(f"Could not remove {chunk_writer.outdir}")
+    return merged
+
+
+def _iter_regions_unprocessed_parallel(
+    filepath,
+    params,
+    image_writer,
+    num_workers,
+    image_paths,
+    prescan,
+    page_scans,
+    page_numbers,
+    progress,
+):
+    page_list = list(range(count_pages(filepath)))
+    if page_numbers:
+        page_list = [i for i in page_list if i in page_numbers]
+    num_chunks = min(len(page_list), num_workers * _CHUNKS_PER_WORKER)
+    chunk_size = max(1, ceil(len(page_list) / max(1, num_chunks)))
+    chunks = [
+        set(page_list[i : i + chunk_size]) for i in range(0, len(page_list), chunk_size)
+    ]
+    chunk_writers = [_chunk_image_writer(image_writer, n) for n in range(len(chunks))]
+    log.debug(f"ingesting {len(page_list)} pages in {len(chunks)} chunks")
+    # spawn, rather than fork, because the server calls this from a worker thread
+    ctx = multiprocessing.get_context("spawn")
+    stop_event = ctx.Event()
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=ctx,
+        initializer=_init_chunk_worker,
+        initargs=(stop_event,),
+    ) as executor:
+        # map returns results in submission order, so regions come in page order
+        results = executor.map(
+            _process_page_chunk,
+            [filepath] * len(chunks),
+            chunks,
+            [params] * len(chunks),
+            chunk_writers,
+            [prescan] * len(chunks),
+        )
+        try:
+            for chunk, chunk_writer, res in zip(chunks, chunk_writers, results):
+                chunk_ur, chunk_imgs, chunk_scans, chunk_refs = res
+                page_scans.extend(chunk_scans)
+                if chunk_writer is not None:
+                    chunk_imgs = _merge_chunk_images(
+                        image_writer, chunk_writer, chunk_imgs, chunk_refs
+                    )
+                image_paths.extend(chunk_imgs)
+                yield from chunk_ur
+                if progress is not None:
+                    for page_num in sorted(chunk):
+                        progress(page_num)
+        finally:
+            # if the caller stopped early, the running chunks end after their
+            #   current page, and those that have not started are cancelled
+            stop_event.set()
+            results.close()
+
+
+def iter_regions_unprocessed(
+    filepath,
+    params=None,
+    image_writer=None,
+    num_workers=None,
+    image_paths=None,
+    prescan=True,
+    page_scans=None,
+    page_numbers=None,
+    progress=None,
+):
+    """Generator of UnprocessedRegion objects, in page order.
+
+    Each region is yielded as soon as the walk of its page/figure is done,
+    so the caller never has to hold the layout of the whole document.
+    The names of images exported by `image_writer` are appended to
+    `image_paths` (if it is not None) as they are written.
+    If `num_workers` is greater than 1, the pages are split into contiguous
+    ranges and parsed in that many worker processes. The results are the
+    same as the serial parse.
+    If `prescan` is True, pages whose content stream has no path operators
+    or form XObjects are skipped (unless they hold images and there is an
+    `image_writer`). The PageScan of each page is appended to `page_scans`.
+    If `page_numbers` is not empty, only the pages with those (0-based)
+    indices are parsed.
+    If `progress` is not None, it is called with the (0-based) index of each
+    page after all of the regions of that page have been yielded (or the page
+    was skipped).
+    An exception raised by `progress` stops the parse and propagates to
+    the caller.
+    """
+    if image_paths is None:
+        image_paths = []
+    if page_scans is None:
+        page_scans = []
+    if num_workers is not None and num_workers > 1:
+        yield from _iter_regions_unprocessed_parallel(
+            filepath,
+            params,
+            image_writer,
+            num_workers,
+            image_paths,
+            prescan,
+            page_scans,
+            page_numbers,
+            progress,
+        )
+        return
+    page_filter = _progress_page_filter(
+        _page_filter(prescan, page_scans, image_writer), progress
+    )
+    for pag_tup in my_extract_pages(
+        filepath, page_numbers=page_numbers, page_filter=page_filter
+    ):
+        yield from _process_page(image_paths, pag_tup, params, image_writer)
+        if progress is not None:
+            progress(pag_tup[-1])
+
+
+def get_regions_unprocessed(
+    filepath,
+    params=None,
+    image_writer=None,
+    num_workers=None,
+    prescan=True,
+    page_numbers=None,
+):
+    """Returns a list of UnprocessedRegion objects and a list of image paths.
+
+    See iter_regions_unprocessed for a version that does not hold every region.
+    """
+    image_paths = []
+    ur = list(
+        iter_regions_unprocessed(
+            filepath,
+            params=params,
+            image_writer=image_writer,
+            num_workers=num_workers,
+            image_paths=image_paths,
+            prescan=prescan,
+            page_numbers=page_numbers,
+        )
+    )
     return ur, image_paths
 
 
-def do_extraction(fp, extract_cfg, image_writer=None):
+def do_extraction(
+    fp, extract_cfg, image_writer=None, num_workers=None, page_numbers=None
+):
     rc = 1
     if fp.endswith(".pdf"):
-        ur, images = get_regions_unprocessed(fp, image_writer=image_writer)
-        for region in ur:
-            tree = print_and_return_tree(extract_cfg, region)
+        for region in iter_regions_unprocessed(
+            fp,
+            image_writer=image_writer,
+            num_workers=num_workers,
+            page_numbers=page_numbers,
+        ):
+            tree = print_and_return_tree(extract_cfg, region, num_workers=num_workers)
             if tree:
                 rc = 0
     elif fp.endswith(".pickle"):
@@ -649,26 +1261,63 @@ def do_extraction(fp, extract_cfg, image_writer=None):
             with open(fp, "rb") as pin:
                 em = ExtractionManager.unpickle(pin)
         em.set_extract_config(extract_cfg)
-        if em.analyze_print_and_return_tree() is not None:
+        if em.analyze_print_and_return_tree(num_workers=num_workers) is not None:
             rc = 0
     return rc
 
 
-def main(fp, config_fp, image_dir=None):
+def main(fp, config_fp, image_dir=None, num_workers=None, page_numbers=None):
     if image_dir:
         if not os.path.isdir(image_dir):
             os.makedirs(image_dir)
         iw = ImageWriter(image_dir)
     else:
         iw = None
-    if fp == config_fp:
+    if config_fp is None or fp == config_fp:
         ec = ExtractionConfig()
     else:
         with open(config_fp, "r") as cinp:
             obj = json.load(cinp)
         ec = ExtractionConfig(obj)
-    return do_extraction(fp, extract_cfg=ec, image_writer=iw)
+    return do_extraction(
+        fp,
+        extract_cfg=ec,
+        image_writer=iw,
+        num_workers=num_workers,
+        page_numbers=page_numbers,
+    )
+
+
+def parse_cli_args(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Extract trees from a pdf or a pickled page/region."
+    )
+    parser.add_argument("input", help="path to a .pdf or .pickle file")
+    parser.add_argument(
+        "config", nargs="?", default=None, help="JSON file of extraction settings"
+    )
+    parser.add_argument(
+        "--pages",
+        type=parse_page_ranges,
+        default=None,
+        help='pages of the pdf to parse, e.g. "3-5,47". The first page is 1.',
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="number of processes used to parse the pdf and to score its components",
+    )
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
-    main(sys.argv[1], sys.argv[-1])
+    args = parse_cli_args()
+    main(
+        args.input,
+        args.config,
+        num_workers=args.workers,
+        page_numbers=args.pages,
+    )
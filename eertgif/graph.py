@@ -3,20 +3,38 @@ from __future__ import annotations
 import logging
 from typing import List, Tuple, Union, Optional
 
-from pdfminer.utils import Point
+from pdfminer.utils import Point, Rect
 from .point_map import PointMap
-from .util import Direction, calc_dist, all_corner_shapes, AxisDir, find_closest
+from .util import (
+    Direction,
+    calc_dist,
+    all_corner_shapes,
+    AxisDir,
+    find_closest,
+    set_slots_state,
+)
 from .safe_containers import SafeCurve, SafeTextLine, CurveShape
+from .spatial import BoxIndex, PointGrid, DEFAULT_CELL_SIZE
 
 log = logging.getLogger(__name__)
 
 
 class Node(object):
+    # graphs of large trees have many nodes and edges, so they are slotted
+    __slots__ = (
+        "eertgif_id",
+        "loc",
+        "edges",
+        "component_idx",
+        "grid_key",
+        "__weakref__",
+    )
+
     def __init__(
         self, x: float = None, y: float = None, loc: Point = None, id_gen=None
     ):
-        self.eertgif_id = None if id_gen is None else id_gen.get_new_id()
-        log.debug(f"created node {self.eertgif_id} at {(x, y)}")
+        self.eertgif_id = None if id_gen is None else id_gen.get_new_id(self)
+        log.debug("created node %s at %s", self.eertgif_id, (x, y))
         if loc is None:
             assert x is not None
             assert y is not None
@@ -25,6 +43,9 @@ class Node(object):
             self.loc = loc
         self.edges = set()
         self.component_idx = None
+        self.grid_key = None  # set by the PlanarContainer that holds the node
+
+    __setstate__ = set_slots_state
 
     def add_edge(self, edge: Edge) -> None:
         self.edges.add(edge)
@@ -38,10 +59,16 @@ class Node(object):
         seen = taboo if taboo is not None else set()
         seen.add(self)
         nd_set.add(self)
-        for edge in self.edges:
-            for n in [edge.nd1, edge.nd2]:
-                if (n is not self) and (n not in seen):
-                    n.add_connected(nd_set, taboo=seen)
+        # explicit stack, as long paths would exceed the recursion limit
+        stack = [self]
+        while stack:
+            curr = stack.pop()
+            for edge in curr.edges:
+                for n in (edge.nd1, edge.nd2):
+                    if n not in seen:
+                        seen.add(n)
+                        nd_set.add(n)
+                        stack.append(n)
 
     def adjacent(self) -> list:
         return [i.other_node(self) for i in self.edges]
@@ -86,12 +113,16 @@ class Node(object):
 
 
 class Edge(object):
+    __slots__ = ("curve", "nd1", "nd2", "eertgif_id", "__weakref__")
+
     def __init__(self, curve: SafeCurve, nd1: Node, nd2: Node, id_gen):
         self.curve, self.nd1, self.nd2 = curve, nd1, nd2
-        self.eertgif_id = None if id_gen is None else id_gen.get_new_id()
+        self.eertgif_id = None if id_gen is None else id_gen.get_new_id(self)
         nd1.add_edge(self)
         nd2.add_edge(self)
 
+    __setstate__ = set_slots_state
+
     @property
     def component_idx(self):
         return self.nd1.component_idx
@@ -147,18 +178,14 @@ class Edge(object):
                     me = pt[idx]
         return me_pt
 
-    def axis_contains(self, axis, point, tol):
-        """
-        Uses effective diganal and shape to find axes.
-        returns:
-            False, None, None  or
-            True, list of lenght 2 of coordinates with variable coord None, dixt
+    def base_axis_coord(self, axis) -> Optional[float]:
+        """Returns the constant coordinate of the `axis` of a corner-shaped curve.
+
+        None for curves that are not corners.
         """
         c = self.curve
-        false_ret = False, None, None
         if (c.eff_diagonal is None) or (c.shape not in all_corner_shapes):
-            # No axis unless a corner
-            return false_ret
+            return None
         eff_d1, eff_d2 = c.eff_diagonal
         if axis == AxisDir.VERTICAL:
             cidx = 0
@@ -173,7 +200,22 @@ class Edge(object):
                 ext_fn = min
             else:
                 ext_fn = max
-        ax_const_coord = ext_fn(eff_d1[cidx], eff_d2[cidx])
+        return ext_fn(eff_d1[cidx], eff_d2[cidx])
+
+    def axis_contains(self, axis, point, tol):
+        """
+        Uses effective diganal and shape to find axes.
+        returns:
+            False, None, None  or
+            True, list of lenght 2 of coordinates with variable coord None, dixt
+        """
+        false_ret = False, None, None
+        ax_const_coord = self.base_axis_coord(axis)
+        if ax_const_coord is None:
+            # No axis unless a corner
+            return false_ret
+        eff_d1, eff_d2 = self.curve.eff_diagonal
+        cidx = 0
         pc = point[cidx]
         cdist = abs(pc - ax_const_coord)
         if cdist > tol:
@@ -210,30 +252,34 @@ class Edge(object):
 
 
 class PlanarContainer(object):
-    def __init__(self, id_gen):
+    def __init__(self, id_gen, cell_size=DEFAULT_CELL_SIZE):
         self.id_gen = id_gen
-        self.eertgif_id = None if id_gen is None else id_gen.get_new_id()
+        self.eertgif_id = None if id_gen is None else id_gen.get_new_id(self)
         self.by_x = PointMap()
-        self._all_nodes = []
+        # dict used as an insertion-ordered set of nodes
+        self._all_nodes = {}
+        self._grid = PointGrid(cell_size)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "_grid" not in state or "_grid_keys" in state:
+            # pickled before nodes knew their grid cells
+            self.__dict__.pop("_grid_keys", None)
+            self._all_nodes = dict.fromkeys(self._all_nodes)
+            self._grid = PointGrid(
+                self._grid.cell_size if "_grid" in state else DEFAULT_CELL_SIZE
+            )
+            for nd in self._all_nodes:
+                nd.grid_key = self._grid.insert(nd.loc, nd)
+
+    def __len__(self):
+        return len(self._all_nodes)
 
     def iter_nodes(self):
         return iter(self._all_nodes)
 
     def find_closest(self, point: Point, tol: float) -> Union[None, Node]:
-        ptx, pty = point
-        rows = self._find_closest_rows(ptx, tol)
-        if not rows:
-            return None
-        min_diff = tol
-        min_el = None
-        for row_x, row_map in rows:
-            for cell_y, nd_list in row_map.items():
-                for el in nd_list:
-                    dist = calc_dist((ptx, pty), el.loc)
-                    if dist < min_diff:
-                        min_diff = dist
-                        min_el = el
-        return min_el
+        return self._grid.nearest(point, tol)[1]
 
     def find_exact(self, point: Point) -> Union[None, Node]:
         ptx, pty = point
@@ -250,52 +296,147 @@ class PlanarContainer(object):
     def find_row_exact(self, x: float) -> Optional[PointMap]:
         return self.by_x.get(x)
 
-    def _find_closest_rows(self, x: float, tol: float) -> List[PointMap]:
-        by_dist = []
-        for n, row_tup in enumerate(self.by_x.items()):
-            row_x, row_map = row_tup
-            dist = abs(row_x - x)
-            if dist < tol:
-                by_dist.append((dist, n, (row_x, row_map)))
-        by_dist.sort()
-        return [i[-1] for i in by_dist]
-
     def new_at(self, pt: Point) -> Node:
         ptx = pt[0]
         pty = pt[1]
         row_map = self.by_x.setdefault(ptx, PointMap())
         nd = Node(ptx, pty, id_gen=self.id_gen)
-        self._all_nodes.append(nd)
+        self._all_nodes[nd] = None
         row_map.setdefault(pty, []).append(nd)
+        nd.grid_key = self._grid.insert(nd.loc, nd)
         return nd
 
     def remove_node(self, nd):
-        del_top_key = None
-        for x, row in self.by_x.items():
-            del_y_key = None
-            for y, nd_ref in row.items():
-                if nd_ref is nd:
-                    del_y_key = y
-            if del_y_key:
-                nd_list = row[del_y_key]
-                nd_list.remove(nd)
-                if not nd_list:
-                    del row[del_y_key]
-            if not row:
-                del_top_key = x
-        if del_top_key is not None:
-            del self.by_x[del_top_key]
-        self._all_nodes.remove(nd)
+        ptx, pty = nd.loc
+        row_map = self.by_x[ptx]
+        nd_list = row_map[pty]
+        nd_list.remove(nd)
+        if not nd_list:
+            del row_map[pty]
+            if not row_map:
+                del self.by_x[ptx]
+        del self._all_nodes[nd]
+        self._grid.remove(nd.grid_key)
+        nd.grid_key = None
+
+
+class DisjointSet(object):
+    """Union-find over hashable items, with path halving and union by size.
+
+    Each set also keeps the smallest insertion order of its members, so
+    that sets can be listed in the order of their first member.
+    """
+
+    def __init__(self):
+        self._parent = {}
+        self._size = {}
+        self._first = {}
+        self.version = 0  # incremented whenever the partition changes
+
+    def __len__(self):
+        return len(self._parent)
+
+    def __contains__(self, item):
+        return item in self._parent
+
+    def add(self, item) -> None:
+        if item in self._parent:
+            return
+        self._parent[item] = item
+        self._size[item] = 1
+        self._first[item] = len(self._parent)
+        self.version += 1
+
+    def clear(self) -> None:
+        self._parent.clear()
+        self._size.clear()
+        self._first.clear()
+        self.version += 1
+
+    def find(self, item):
+        parent = self._parent
+        while True:
+            p = parent[item]
+            if p is item:
+                return item
+            gp = parent[p]
+            parent[item] = gp
+            item = gp
+
+    def union(self, item1, item2) -> bool:
+        """Joins the sets holding the items, returns False if they were already joined."""
+        r1, r2 = self.find(item1), self.find(item2)
+        if r1 is r2:
+            return False
+        if self._size[r1] < self._size[r2]:
+            r1, r2 = r2, r1
+        self._parent[r2] = r1
+        self._size[r1] += self._size.pop(r2)
+        self._first[r1] = min(self._first[r1], self._first.pop(r2))
+        self.version += 1
+        return True
+
+    def first_order(self, item) -> int:
+        """Insertion order of the first member of the set that holds `item`."""
+        return self._first[self.find(item)]
+
+
+_UNKNOWN_MERGES = ("unknown",)
 
 
 class GraphFromEdges(object):
     def __init__(self, id_gen, node_merge_tol=0.01):
-        self.nodes = PlanarContainer(id_gen)
+        # nodes are merged within node_merge_tol, so use that as the grid size
+        self.nodes = PlanarContainer(id_gen, cell_size=node_merge_tol)
         self.edges = set()
+        # connected components, kept up to date by add_curve and force_merge
+        self.node_sets = DisjointSet()
+        self._edge_by_curve_id = {}
+        # (orientation, rect_base_intercept_tol) of the rect-shape joins that
+        #   have been forced into this graph, or None
+        self.rect_merge_cfg = None
         self.tol = node_merge_tol
-        self.eertgif_id = None if id_gen is None else id_gen.get_new_id()
+        self.eertgif_id = None if id_gen is None else id_gen.get_new_id(self)
         self.id_gen = id_gen
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "node_sets" not in state:
+            # pickled before components were tracked
+            self.node_sets = DisjointSet()
+            self._rebuild_node_sets()
+        if "rect_merge_cfg" not in state:
+            # pickled before joins were tracked, it may hold unknown joins
+            self.rect_merge_cfg = _UNKNOWN_MERGES
+            self._edge_by_curve_id = {e.curve.eertgif_id: e for e in self.edges}
+
+    def _rebuild_node_sets(self):
+        node_sets = self.node_sets
+        node_sets.clear()
+        for nd in self.iter_nodes():
+            node_sets.add(nd)
+        for edge in self.edges:
+            node_sets.union(edge.nd1, edge.nd2)
+
+    def has_curve(self, curve_id) -> bool:
+        return curve_id in self._edge_by_curve_id
+
+    def iter_curve_ids(self):
+        return iter(self._edge_by_curve_id)
+
+    def same_component(self, nd1: Node, nd2: Node) -> bool:
+        return self.node_sets.find(nd1) is self.node_sets.find(nd2)
+
+    def connected_components(self) -> List[set]:
+        """Returns the sets of connected nodes, ordered by their first node."""
+        by_root = {}
+        node_sets = self.node_sets
+        for nd in self.iter_nodes():
+            by_root.setdefault(node_sets.find(nd), set()).add(nd)
+        roots = list(by_root.keys())
+        roots.sort(key=node_sets.first_order)
+        return [by_root[r] for r in roots]
+
     def debug_check(self):
         evisited = set()
         nds_visited = set()
@@ -329,8 +470,25 @@ class GraphFromEdges(object):
         nd2 = self.find_or_insert_node(pt2, avoid=nd1)[0]
         edge = Edge(curve, nd1, nd2, id_gen=self.id_gen)
         self.edges.add(edge)
+        self._edge_by_curve_id[curve.eertgif_id] = edge
+        self.node_sets.union(nd1, nd2)
         return edge
 
+    def remove_curves(self, curve_ids) -> None:
+        """Removes the edges for the curves, and any nodes left without edges.
+
+        The union-find cannot split sets, so the components are recomputed
+        once all of the edges are gone.
+        """
+        for curve_id in curve_ids:
+            edge = self._edge_by_curve_id.pop(curve_id)
+            self.edges.remove(edge)
+            for nd in (edge.nd1, edge.nd2):
+                nd.edges.discard(edge)
+                if not nd.edges and nd.grid_key is not None:
+                    self.nodes.remove_node(nd)
+        self._rebuild_node_sets()
+
     def force_merge(
         self,
         edge1,  # edge that holds a Node to be merged
@@ -338,7 +496,9 @@ class GraphFromEdges(object):
         edge2,
         var_coord,
     ):
-        self.debug_check()
+        debugging = log.isEnabledFor(logging.DEBUG)
+        if debugging:
+            self.debug_check()
         log.warning(f"Force merge {edge1} and {edge2}")
         # find closest node in edge1
         dist_n1_1 = calc_dist(most_extreme_pt_edge1, (edge1.nd1.x, edge1.nd1.y))
@@ -378,13 +538,14 @@ class GraphFromEdges(object):
             cn2.edges.add(other_edge)
             if other_edge is not edge1:
                 cn1.edges.remove(other_edge)
+        self.node_sets.union(cn1, cn2)
         if len(cn1.edges) == 0:
             log.warning(f"    Force merge removing cn1={cn1}")
             self.nodes.remove_node(cn1)
         else:
             log.warning(f"    Force merge retaining cn1={cn1}")
-
-        self.debug_check()
+        if debugging:
+            self.debug_check()
 
     def find_or_insert_node(
         self, point: Point, tol: float = None, avoid=None
@@ -394,64 +555,116 @@ class GraphFromEdges(object):
         nd = self.nodes.find_exact(point)
         if nd is not None:
             if nd is avoid:
-                nd = self.nodes.new_at(point)
-                return nd, True, True
+                return self._new_node_at(point), True, True
             return nd, False, True
         nd = self.nodes.find_closest(point, t)
         if (nd is not None) and (nd is not avoid):
             return nd, False, False
+        return self._new_node_at(point), True, True
+
+    def _new_node_at(self, point: Point) -> Node:
         nd = self.nodes.new_at(point)
-        return nd, True, True
+        self.node_sets.add(nd)
+        return nd
 
     def build_forest(self) -> Forest:
-        forest = Forest(self, id_gen=self.id_gen)
-        included = set()
-        for nd in self.nodes.iter_nodes():
-            if nd in included:
-                continue
-            nd_set = set()
-            component_idx = len(forest.components)
-            forest.components.append(nd_set)
-            nd.add_connected(nd_set)
-            for nn in nd_set:
-                nn.component_idx = component_idx
-            assert not included.intersection(nd_set)
-            included.update(nd_set)
-        return forest
+        """Returns a Forest whose components are derived from node_sets on demand."""
+        return Forest(self, id_gen=self.id_gen)
+
+
+def component_skeleton(
+    nodes: List[Node],
+) -> Tuple[List[Point], List[Tuple[int, int]]]:
+    """Returns the locations of `nodes` and their edges as pairs of indices.
+
+    Curves are left out, so the result is cheap to send to another process.
+    Every edge must join two of `nodes` (as they do in a component).
+    """
+    nodes = list(nodes)
+    idx_of = {nd: n for n, nd in enumerate(nodes)}
+    edge_pairs, seen = [], set()
+    for nd in nodes:
+        for edge in nd.edges:
+            if edge not in seen:
+                seen.add(edge)
+                edge_pairs.append((idx_of[edge.nd1], idx_of[edge.nd2]))
+    return [nd.loc for nd in nodes], edge_pairs
+
+
+def nodes_from_skeleton(
+    locs: List[Point], edge_pairs: List[Tuple[int, int]], id_gen=None
+) -> List[Node]:
+    """Inverse of component_skeleton. The edges have no curves.
+
+    The nodes get ids from `id_gen` in the order of `locs`, then the edges.
+    """
+    nodes = [Node(loc=loc, id_gen=id_gen) for loc in locs]
+    for i, j in edge_pairs:
+        Edge(None, nodes[i], nodes[j], id_gen=id_gen)
+    return nodes
 
 
 class Forest(object):
     def __init__(self, graph: GraphFromEdges, id_gen):
-        self.components = []
+        self._components = []
+        self._components_version = None
         self.graph = graph
         self.trees = []
         self.legends = []
         self.id_gen = id_gen
-        self.eertgif_id = None if id_gen is None else id_gen.get_new_id()
+        self.eertgif_id = None if id_gen is None else id_gen.get_new_id(self)
         self.rect_base_intercept_tol = None
 
     def clear_trees(self):
         self.trees.clear()
         self.legends.clear()
 
-    def _post_merge_hook(self, c1_idx, c2_idx):
-        assert c1_idx != c2_idx
-        min_idx, max_idx = min(c1_idx, c2_idx), max(c1_idx, c2_idx)
-        to_die_list = self.components[max_idx]
-        to_grow_list = self.components[min_idx]
-        for nd in to_die_list:
-            nd.component_idx = min_idx
-            to_grow_list.add(nd)
-        self.components.pop(max_idx)
-        for to_decr_list in self.components[max_idx:]:
-            assert to_decr_list
-            bef_idx = next(iter(to_decr_list)).component_idx
-            new_idx = bef_idx - 1
-            for nd in to_decr_list:
-                nd.component_idx = new_idx
-        return len(self.components)
-
-    def interpret_as_legend(self, idx: int, text_lines: List[SafeTextLine]):
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "components" in state:
+            # pickled when components were stored as a list
+            self._components = self.__dict__.pop("components")
+            self._components_version = None
+
+    @property
+    def components(self) -> List[set]:
+        """Sets of connected nodes, in the order of their first node.
+
+        Recomputed (and the component_idx of every node reassigned)
+        only when the graph's node_sets have changed.
+        """
+        version = self.graph.node_sets.version
+        if self._components_version != version:
+            self._components = self.graph.connected_components()
+            for component_idx, nd_set in enumerate(self._components):
+                for nd in nd_set:
+                    nd.component_idx = component_idx
+            self._components_version = version
+        return self._components
+
+    def component_bbox(self, idx: int) -> Rect:
+        """Returns the bounding box of the locations of the nodes in component `idx`."""
+        comp = self.components[idx]
+        xs = [nd.x for nd in comp]
+        ys = [nd.y for nd in comp]
+        return min(xs), min(ys), max(xs), max(ys)
+
+    def text_near_component(self, idx: int, text_index: BoxIndex) -> List[SafeTextLine]:
+        """Returns the text lines that are close enough to be labels of component `idx`.
+
+        That is, those in `text_index` (a BoxIndex of the region's text lines)
+        that overlap the bbox of the component after it is grown on every
+        side by the larger of its width and height.
+        """
+        x0, y0, x1, y1 = self.component_bbox(idx)
+        margin = max(x1 - x0, y1 - y0)
+        return text_index.overlapping(
+            (x0 - margin, y0 - margin, x1 + margin, y1 + margin)
+        )
+
+    def interpret_as_legend(
+        self, idx: int, text_lines: List[SafeTextLine], closest=None
+    ):
         from .phylo import PhyloLegend
 
         comp = self.components[idx]
@@ -466,6 +679,7 @@ class Forest(object):
                 forest=self,
                 text_lines=text_lines,
                 id_gen=self.id_gen,
+                closest=closest,
             )
             self.legends[idx] = t
         except RuntimeError:
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""On-disk cache of the results of parsing an uploaded pdf.
+
+Entries are keyed by the SHA-256 of the pdf and the settings that affect
+the parse. Each entry is a directory holding the pickled UnprocessedRegion
+objects, the exported images and a manifest.json. A repeat upload of the
+same pdf links (or copies) those files into the new upload's directory
+instead of parsing the pdf again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from threading import Lock
+from typing import Optional
+
+log = logging.getLogger("eertgif.ingest_cache")
+
+# bump this if the pickled UnprocessedRegion or manifest formats change.
+CACHE_FORMAT_VERSION = 3
+DEFAULT_MAX_BYTES = 500 * 1024 * 1024
+CACHE_DIR_NAME = ".ingest_cache"
+_manifest_fn = "manifest.json"
+_img_dir_name = "img"
+_cache_lock = Lock()
+
+
+def _link_or_copy(src, dest):
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+def _dir_size(d):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(d):
+        for fn in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, fn))
+            except OSError:
+                pass
+    return total
+
+
+class IngestCache(object):
+    """Size-bounded, least-recently-used cache of parsed pdfs.
+
+    The recency of an entry is the mtime of its manifest, which is
+    touched on every hit.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key_for(pdf_path, settings) -> str:
+        """Returns the hex digest of the pdf contents and the parse `settings`."""
+        h = hashlib.sha256()
+        with open(pdf_path, "rb") as inp:
+            while True:
+                buf = inp.read(1 << 20)
+                if not buf:
+                    break
+                h.update(buf)
+        blob = {"version": CACHE_FORMAT_VERSION, "settings": settings}
+        h.update(json.dumps(blob, sort_keys=True).encode("utf-8"))
+        return h.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def restore(self, key, dest_dir) -> Optional[dict]:
+        """Links the cached files for `key` into `dest_dir`.
+
+        Pickles go in `dest_dir` and images in `dest_dir`/img.
+        Returns the manifest (with "unprocessed", "images", "image_refs" and
+        "page_scans" lists), or None if there is no usable entry for `key`.
+        """
+        entry_dir = self._entry_dir(key)
+        manifest_fp = os.path.join(entry_dir, _manifest_fn)
+        with _cache_lock:
+            try:
+                with open(manifest_fp, "r", encoding="utf-8") as inp:
+                    manifest = json.load(inp)
+            except FileNotFoundError:
+                return None
+            except:
+                log.exception(f"Unreadable ingest cache manifest {manifest_fp}")
+                return None
+            linked = []
+            try:
+                for fn in manifest["unprocessed"]:
+                    dest = os.path.join(dest_dir, fn)
+                    _link_or_copy(os.path.join(entry_dir, fn), dest)
+                    linked.append(dest)
+                img_dir = os.path.join(dest_dir, _img_dir_name)
+                if manifest["images"] and not os.path.isdir(img_dir):
+                    os.makedirs(img_dir)
+                for fn in manifest["images"]:
+                    dest = os.path.join(img_dir, fn)
+                    _link_or_copy(os.path.join(entry_dir, _img_dir_name, fn), dest)
+                    linked.append(dest)
+            except OSError:
+                log.exception(f"Could not restore ingest cache entry {key}")
+                for fp in linked:
+                    try:
+                        os.remove(fp)
+                    except OSError:
+                        pass
+                return None
+            os.utime(manifest_fp)
+        log.debug(f"ingest cache hit for {key}")
+        return manifest
+
+    def store(self, key, src_dir, manifest) -> None:
+        """Adds the files listed in `manifest` (from `src_dir`) as the entry for `key`.
+
+        Failures are logged, but not raised, as the cache is only an optimization.
+        """
+        if self.max_bytes <= 0:
+            return
+        with _cache_lock:
+            if os.path.exists(self._entry_dir(key)):
+                return
+            try:
+                if not os.path.isdir(self.cache_dir):
+                    os.makedirs(self.cache_dir)
+                tmp_dir = tempfile.mkdtemp(dir=self.cache_dir)
+            except OSError:
+                log.exception("Could not create an ingest cache entry")
+                return
+            try:
+                for fn in manifest["unprocessed"]:
+                    _link_or_copy(os.path.join(src_dir, fn), os.path.join(tmp_dir, fn))
+                if manifest["images"]:
+                    os.makedirs(os.path.join(tmp_dir, _img_dir_name))
+                for fn in manifest["images"]:
+                    _link_or_copy(
+                        os.path.join(src_dir, _img_dir_name, fn),
+                        os.path.join(tmp_dir, _img_dir_name, fn),
+                    )
+                with open(
+                    os.path.join(tmp_dir, _manifest_fn), "w", encoding="utf-8"
+                ) as jout:
+                    json.dump(manifest, jout, sort_keys=True, indent=2)
+                os.rename(tmp_dir, self._entry_dir(key))
+            except OSError:
+                log.exception(f"Could not store ingest cache entry {key}")
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return
+            self._evict_lock_held()
+
+    def _evict_lock_held(self):
+        """Removes the least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            manifest_fp = os.path.join(entry_dir, _manifest_fn)
+            if not os.path.isfile(manifest_fp):
+                continue  # partially written entry or stray file
+            size = _dir_size(entry_dir)
+            total += size
+            entries.append((os.path.getmtime(manifest_fp), name, size))
+        entries.sort()
+        for mtime, name, size in entries:
+            if total <= self.max_bytes:
+                break
+            log.debug(f"evicting ingest cache entry {name} ({size} bytes)")
+            shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+            total -= size
@@ -3,10 +3,11 @@ from __future__ import annotations
 
 import logging
 from io import StringIO
-from typing import List, Set
+from typing import Iterator, List, Optional, Set, Tuple
 
 from .graph import Node, Forest, Edge
 from .safe_containers import SafeTextLine
+from .spatial import PointGrid
 from .util import (
     find_closest_first,
     Penalty,
@@ -19,6 +20,7 @@ from .util import (
     CARDINAL,
     midpoint,
     calc_dist,
+    set_slots_state,
 )
 
 log = logging.getLogger(__name__)
@@ -30,6 +32,9 @@ class CycleDetected(ValueError):
 
 
 class PhyloTree(object):
+    # text of the region that was not offered to the tree (set by the caller)
+    unoffered_text = ()
+
     def __init__(
         self,
         connected_nodes: Set[Node] = None,
@@ -48,7 +53,7 @@ class PhyloTree(object):
         # assert 123 not in id_list
 
         self.id_gen = id_gen
-        self.eertgif_id = None if id_gen is None else id_gen.get_new_id()
+        self.eertgif_id = None if id_gen is None else id_gen.get_new_id(self)
         self.forest = forest
         self.used_text = set()
         self.root = None
@@ -59,7 +64,7 @@ class PhyloTree(object):
         for nd in connected_nodes:
             cont = ext_nds if len(nd.edges) == 1 else int_nds
             if len(nd.edges) > 1:
-                log.debug(f"nd{(nd.x, nd.y)} seems internal: nd.edges = {nd.edges}")
+                log.debug("nd%s seems internal: nd.edges = %s", (nd.x, nd.y), nd.edges)
             cont.append(nd)
             lx = min(lx, nd.x)
             ly = min(ly, nd.y)
@@ -91,28 +96,46 @@ class PhyloTree(object):
         #     f"nodes_bbox = {nodes_bbox} text_bbox={text_bbox} {len(horiz_text)}, {len(vert_text)}"
         # )
         dir_list = CARDINAL if tip_dir is None else [tip_dir]
-        from .phylo_map_attempt import PhyloMapAttempt
-
-        by_dir = [
-            PhyloMapAttempt(
-                id_gen=self.id_gen,
-                tip_dir=i,
-                internals=int_nds,
-                externals=ext_nds,
-                horiz_text=horiz_text,
-                vert_text=vert_text,
-            )
-            for i in dir_list
+        from .phylo_map_attempt import PhyloMapAttempt, score_lower_bound
+
+        # Try the directions with the lowest bounds first, and skip any whose
+        #   bound shows that it cannot beat the best attempt so far. Ties
+        #   go to the earlier direction in dir_list, as they always have.
+        bounds = [
+            (score_lower_bound(i, ext_nds, horiz_text, vert_text), n)
+            for n, i in enumerate(dir_list)
         ]
-        min_score, best_attempt = float("inf"), None
-        for attempt in by_dir:
+        bounds.sort()
+        min_score, best_idx, best_attempt = float("inf"), None, None
+        attempts = {}
+
+        def attempt_for(n):
+            if n not in attempts:
+                attempts[n] = PhyloMapAttempt(
+                    id_gen=self.id_gen,
+                    tip_dir=dir_list[n],
+                    internals=int_nds,
+                    externals=ext_nds,
+                    horiz_text=horiz_text,
+                    vert_text=vert_text,
+                )
+            return attempts[n]
+
+        for bound, n in bounds:
+            if bound == float("inf") or bound > min_score:
+                break
+            if bound == min_score and n > best_idx:
+                continue
+            attempt = attempt_for(n)
             s = attempt.score
-            if s < min_score:
-                min_score = s
-                best_attempt = attempt
+            if s < min_score or (
+                best_idx is not None and s == min_score and n < best_idx
+            ):
+                min_score, best_idx, best_attempt = s, n, attempt
             # print(f"Attempt score = {attempt.score} from {attempt.penalties}")
+        log.debug(f"{len(attempts)} of {len(dir_list)} tip directions attempted")
         if best_attempt is None:
-            best_attempt = by_dir[0]
+            best_attempt = attempt_for(0)
         self.pma = best_attempt
         self.root = best_attempt.root
 
@@ -156,7 +179,9 @@ class PhyloTree(object):
     def unused_text(self):
         if self.pma is None:
             return []
-        return self.pma.unused_text
+        u = self.pma.unused_text
+        u.extend(self.unoffered_text)
+        return u
 
     @property
     def num_tips(self):
@@ -219,14 +244,25 @@ def min_coord_west(n):
 class PhyloTreeData(object):
     """Blob of data common to all nodes/edges"""
 
+    __slots__ = (
+        "eertgif_id",
+        "_tip_dir",
+        "pos_min_fn",
+        "child_pos_fn",
+        "attempt",
+        "__weakref__",
+    )
+
     def __init__(self, tip_dir: Direction = None, attempt=None, id_gen=None):
-        self.eertgif_id = None if id_gen is None else id_gen.get_new_id()
+        self.eertgif_id = None if id_gen is None else id_gen.get_new_id(self)
         self._tip_dir = None
         self.pos_min_fn = None
         self.child_pos_fn = None
         self.attempt = attempt
         self.tip_dir = tip_dir
 
+    __setstate__ = set_slots_state
+
     @property
     def tip_dir(self):
         return self._tip_dir
@@ -246,6 +282,24 @@ class PhyloTreeData(object):
 
 
 class PhyloNode(object):
+    __slots__ = (
+        "eertgif_id",
+        "vnode",
+        "label_obj",
+        "_unsorted_children",
+        "_adjacent_by_vedge",
+        "_adjacent_by_phynode",
+        "par",
+        "orig_vedge_to_par",
+        "children",
+        "is_root",
+        "phy_ctx",
+        "_collapsed",
+        "merged",
+        "_label",
+        "__weakref__",
+    )
+
     def __init__(
         self,
         vnode: Node = None,
@@ -253,7 +307,7 @@ class PhyloNode(object):
         phy_ctx: PhyloTreeData = None,  # alias to mapping's data struct
         id_gen=None,
     ):
-        self.eertgif_id = None if id_gen is None else id_gen.get_new_id()
+        self.eertgif_id = None if id_gen is None else id_gen.get_new_id(self)
         if vnode:
             assert isinstance(vnode, Node)
         self.vnode = vnode
@@ -270,6 +324,8 @@ class PhyloNode(object):
         self.merged = None
         self._label = None
 
+    __setstate__ = set_slots_state
+
     @property
     def label(self):
         if self._label:
@@ -332,11 +388,27 @@ class PhyloNode(object):
         par.sort_children()
 
     def post_order(self) -> List[PhyloNode]:
-        nd_list = []
-        for c in self._unsorted_children:
-            nd_list.extend(c.post_order())
-        nd_list.append(self)
-        return nd_list
+        return list(self.iter_post_order())
+
+    def iter_post_order(self) -> Iterator[PhyloNode]:
+        """Yields the nodes of this subtree, children (in _unsorted_children order) first."""
+        stack = [(self, iter(self._unsorted_children))]
+        while stack:
+            nd, child_it = stack[-1]
+            child = next(child_it, None)
+            if child is None:
+                stack.pop()
+                yield nd
+            else:
+                stack.append((child, iter(child._unsorted_children)))
+
+    def iter_pre_order(self) -> Iterator[PhyloNode]:
+        """Yields the nodes of this subtree, parents before their children."""
+        stack = [self]
+        while stack:
+            nd = stack.pop()
+            yield nd
+            stack.extend(reversed(nd._unsorted_children))
 
     def collapse_short_internals(self, min_br):
         post_nds = self.post_order()
@@ -354,26 +426,37 @@ class PhyloNode(object):
         pma = self.phy_ctx.attempt
         coord_fn = self.phy_ctx.pos_min_fn
 
-        if self in seen:
-            raise CycleDetected(f"node with edges {self.vnode.edges} in a cycle")
-        seen.add(self)
-        self.par = par
-        if par is not None:
-            self.orig_vedge_to_par = self._adjacent_by_phynode[par]
-            sc = coord_fn(self)
-            pc = coord_fn(par)
-            if sc < pc and abs(pc - sc) > COORD_TOL:
-                pma.add_penalty(Penalty.WRONG_DIR_TO_PAR, 1)
-        for adj in self._adjacent_by_vedge.values():
-            if adj is par:
-                continue
-            if adj is self:
-                # raise CycleDetected("I'm just beside myself")
-                log.debug("I'm just beside myself cycle, skipping edge")
-                continue
-            self._unsorted_children.append(adj)
-            adj.root_based_on_par(par=self, seen=seen)
-        self.sort_children()
+        def _enter(nd, nd_par):
+            if nd in seen:
+                raise CycleDetected(f"node with edges {nd.vnode.edges} in a cycle")
+            seen.add(nd)
+            nd.par = nd_par
+            if nd_par is not None:
+                nd.orig_vedge_to_par = nd._adjacent_by_phynode[nd_par]
+                sc = coord_fn(nd)
+                pc = coord_fn(nd_par)
+                if sc < pc and abs(pc - sc) > COORD_TOL:
+                    pma.add_penalty(Penalty.WRONG_DIR_TO_PAR, 1)
+            return nd, iter(list(nd._adjacent_by_vedge.values()))
+
+        # depth-first with an explicit stack, so that deep (ladderized) trees
+        #   do not hit the recursion limit. Children are sorted on the way up.
+        stack = [_enter(self, par)]
+        while stack:
+            nd, adj_it = stack[-1]
+            for adj in adj_it:
+                if adj is nd.par:
+                    continue
+                if adj is nd:
+                    # raise CycleDetected("I'm just beside myself")
+                    log.debug("I'm just beside myself cycle, skipping edge")
+                    continue
+                nd._unsorted_children.append(adj)
+                stack.append(_enter(adj, nd))
+                break
+            else:
+                stack.pop()
+                nd.sort_children()
 
     def get_newick(self, edge_len_scaler=None) -> str:
         ostr = StringIO()
@@ -382,20 +465,29 @@ class PhyloNode(object):
         return ostr.getvalue()
 
     def write_newick(self, out, edge_len_scaler=None):
-        """Writes newick to `out` without the trailing ;"""
-        assert self.merged is None
-        if self.children:
-            out.write("(")
-            for n, child in enumerate(self.children):
-                if n != 0:
-                    out.write(",")
-                child.write_newick(out, edge_len_scaler=edge_len_scaler)
-            out.write(")")
-        if self.label_obj:
-            out.write(escape_newick(self.label))
-        if self.par:
-            elen = self.edge_len(scaler=edge_len_scaler)
-            out.write(f":{elen}")
+        """Writes newick to `out` without the trailing ;
+
+        The tree is walked with an explicit stack of (node, index of the
+        next child to write), so deep trees are streamed without recursion.
+        """
+        stack = [(self, 0)]
+        while stack:
+            nd, child_idx = stack.pop()
+            children = nd.children or ()
+            if child_idx == 0:
+                assert nd.merged is None
+            if child_idx < len(children):
+                out.write("(" if child_idx == 0 else ",")
+                stack.append((nd, child_idx + 1))
+                stack.append((children[child_idx], 0))
+                continue
+            if children:
+                out.write(")")
+            if nd.label_obj:
+                out.write(escape_newick(nd.label))
+            if nd.par:
+                elen = nd.edge_len(scaler=edge_len_scaler)
+                out.write(f":{elen}")
 
     def edge_len(self, scaler=None):
         p = self.par
@@ -424,6 +516,20 @@ class PhyloEdge(object):
     pass
 
 
+def _legend_score(legend_text: SafeTextLine, bar: Edge, dist: float):
+    """Returns (score, edge_len_scaler) of a legend pairing `legend_text` with `bar`.
+
+    The score is infinite if the text's number cannot be scaled by the bar.
+    """
+    try:
+        return (
+            abs(DEFAULT_LABEL_GAP - dist),
+            as_numeric(legend_text.get_text())[1] / bar.length,
+        )
+    except:
+        return float("inf"), None
+
+
 class PhyloLegend(object):
     def __init__(
         self,
@@ -431,33 +537,125 @@ class PhyloLegend(object):
         forest: Forest = None,
         text_lines: List[SafeTextLine] = None,
         id_gen=None,
+        closest: Optional[Tuple[float, SafeTextLine, Edge]] = None,
     ):
+        """If `closest` is given, it is the (dist, text, edge) of the legend,
+        as found by a LegendEngine, and the nodes are not searched."""
         self.forest = forest
-        self.eertgif_id = None if id_gen is None else id_gen.get_new_id()
+        self.eertgif_id = None if id_gen is None else id_gen.get_new_id(self)
         self.score = None
-        edges = set()
-        for nd in connected_nodes:
-            for edge in nd.edges:
-                edges.add(edge)
-        edge_list = [(i.midpoint, i) for i in edges]
-        could_be_num = [i for i in text_lines if as_numeric(i.get_text())[0]]
-        line_list = [(midpoint(i.bbox), i) for i in could_be_num]
-        min_d, min_el = float("inf"), None
-        for line_tup in line_list:
-            dist, edge_tup = find_closest_first(line_tup, edge_list)
-            if dist < min_d:
-                min_d = dist
-                min_el = (line_tup[1], edge_tup[1])
+        if closest is None:
+            edges = set()
+            for nd in connected_nodes:
+                for edge in nd.edges:
+                    edges.add(edge)
+            edge_list = [(i.midpoint, i) for i in edges]
+            could_be_num = [i for i in text_lines if as_numeric(i.get_text())[0]]
+            line_list = [(midpoint(i.bbox), i) for i in could_be_num]
+            min_d, min_el = float("inf"), None
+            for line_tup in line_list:
+                dist, edge_tup = find_closest_first(line_tup, edge_list)
+                if dist < min_d:
+                    min_d = dist
+                    min_el = (line_tup[1], edge_tup[1])
+        else:
+            min_d, min_el = closest[0], (closest[1], closest[2])
         if min_el is None:
             raise RuntimeError("Could not find a figure legend in nodes and text")
         self.legend_pair = min_el
         self.bar = min_el[1]
         self.legend_text = min_el[0]
-        self.edge_len_scaler = None
         self.unused_text = set([i for i in text_lines if i is not self.legend_text])
         self.unused_nodes = [i for i in connected_nodes if i is not self.bar]
-        self.score = abs(DEFAULT_LABEL_GAP - min_d)
-        try:
-            self.edge_len_scaler = as_numeric(min_el[0].get_text())[1] / self.bar.length
-        except:
-            self.score = float("inf")
+        self.score, self.edge_len_scaler = _legend_score(
+            self.legend_text, self.bar, min_d
+        )
+
+
+class LegendEngine(object):
+    """Finds the scale bar legend among the small components of a forest.
+
+    The text lines are parsed as numbers once, the numeric ones are held
+    in a PointGrid, and the closest (text, edge) pair found for a component
+    is cached. The cache key is the component's edges (and their end points)
+    with the numeric lines that were offered, so analyzing again after a
+    change that only affects the tree reuses the results.
+    """
+
+    def __init__(self):
+        self._parsed = {}
+        self._graph = None
+        self._closest = {}
+        self._cand_versions = {}
+        self._cand_version = None
+        self._cand_grid = None
+        self._cand_rank = None
+
+    def _set_candidates(self, text_lines: List[SafeTextLine]) -> None:
+        parsed = self._parsed
+        cands = []
+        for line in text_lines:
+            p = parsed.get(line)
+            if p is None:
+                p = parsed[line] = as_numeric(line.get_text())
+            if p[0]:
+                cands.append(line)
+        key = tuple(i.eertgif_id for i in cands)
+        version = self._cand_versions.setdefault(key, len(self._cand_versions))
+        if version != self._cand_version:
+            self._cand_version = version
+            self._cand_grid = PointGrid.from_items((midpoint(i.bbox), i) for i in cands)
+            self._cand_rank = {line: n for n, line in enumerate(cands)}
+
+    def _find_closest(self, comp) -> Optional[Tuple[float, float, SafeTextLine, Edge]]:
+        """Returns (score, dist, text, edge) of the best legend for `comp`, or None.
+
+        Picks the same pair as PhyloLegend's search: the closest, with ties
+        going to the earliest text line.
+        """
+        edge_list = list({edge for nd in comp for edge in nd.edges})
+        key = (
+            frozenset((e, e.nd1.loc, e.nd2.loc) for e in edge_list),
+            self._cand_version,
+        )
+        if key in self._closest:
+            return self._closest[key]
+        best_key, best_pair = None, None
+        grid, rank = self._cand_grid, self._cand_rank
+        for n, edge in enumerate(edge_list):
+            dist, line = grid.nearest(edge.midpoint)
+            if line is None:
+                break  # no numeric text
+            k = (dist, rank[line], n)
+            if best_key is None or k < best_key:
+                best_key, best_pair = k, (line, edge)
+        found = None
+        if best_pair is not None:
+            dist = best_key[0]
+            score = _legend_score(best_pair[0], best_pair[1], dist)[0]
+            found = (score, dist, best_pair[0], best_pair[1])
+        self._closest[key] = found
+        return found
+
+    def best_legend(
+        self, forest: Forest, text_lines: List[SafeTextLine]
+    ) -> Optional[PhyloLegend]:
+        """Returns the best legend for `text_lines` among the components with at most 4 nodes.
+
+        Only the winning component is interpreted (by forest.interpret_as_legend).
+        """
+        if forest.graph is not self._graph:
+            self._graph = forest.graph
+            self._closest.clear()
+        self._set_candidates(text_lines)
+        best_idx, best_found = None, None
+        for n, c in enumerate(forest.components):
+            if len(c) <= 4:
+                found = self._find_closest(c)
+                if found is not None and (
+                    best_found is None or found[0] < best_found[0]
+                ):
+                    best_idx, best_found = n, found
+        if best_found is None or best_found[0] == float("inf"):
+            return None
+        return forest.interpret_as_legend(best_idx, text_lines, closest=best_found[1:])
@@ -2,12 +2,14 @@
 from __future__ import annotations
 
 import logging
+from heapq import heapify, heappop, heapreplace
 from math import sqrt
 from typing import List, Dict, Set, Tuple, Optional
 
 from .phylo import PhyloNode, PhyloTreeData, CycleDetected
 from .graph import Node
 from .safe_containers import SafeTextLine
+from .spatial import PointGrid
 from .util import (
     avg_char_width,
     Penalty,
@@ -15,7 +17,6 @@ from .util import (
     mean_var,
     mean_vector,
     Direction,
-    find_closest,
 )
 
 log = logging.getLogger(__name__)
@@ -53,6 +54,29 @@ def north_south_calc_x(el):
     return (el.x0 + el.x1) / 2.0
 
 
+def score_lower_bound(
+    tip_dir: Direction,
+    externals: List[Node],
+    horiz_text: List[SafeTextLine],
+    vert_text: List[SafeTextLine],
+) -> float:
+    """Returns a lower bound on the score of a PhyloMapAttempt with these arguments.
+
+    Every penalty is non-negative, and a label is matched to at most one
+    tip. So all of the tips in excess of the inline labels, except one
+    that may end up as the root, are penalized as unmatched.
+    The gap penalties are not bounded, because the offset-based matching
+    moves the labels before measuring them.
+    """
+    if tip_dir in (Direction.EAST, Direction.WEST):
+        num_inline = len(horiz_text)
+    else:
+        num_inline = len(vert_text)
+    if not (num_inline and externals):
+        return float("inf")  # no labels can be matched, so no tree is built
+    return float(max(0, len(externals) - num_inline - 1))
+
+
 class PhyloMapAttempt(object):
     def __init__(
         self,
@@ -64,7 +88,7 @@ class PhyloMapAttempt(object):
         vert_text: List[SafeTextLine],
     ):
         self.id_gen = id_gen
-        self.eertgif_id = None if id_gen is None else id_gen.get_new_id()
+        self.eertgif_id = None if id_gen is None else id_gen.get_new_id(self)
         self.penalties = {}
         self.penalty_weights = {}
         self.root = None
@@ -190,17 +214,19 @@ class PhyloMapAttempt(object):
         self, unmatched_labels: List[SafeTextLine], externals: List[Node]
     ):
         calc_x, calc_y = self.calc_x, self.calc_y
+        ext_grid = PointGrid.from_items((ext.loc, ext) for ext in externals)
         by_lab = {}
         label_wrappers = []
         for label_t in unmatched_labels:
             loc = (calc_x(label_t), calc_y(label_t))
-            dist, ext = find_closest(loc, externals)
+            dist, ext = ext_grid.nearest(loc)
             assert ext is not None
             by_lab[label_t] = (ext, dist)
             label_wrappers.append(LocLabWrap(loc=loc, label=label_t))
+        label_grid = PointGrid.from_items((lw.loc, lw) for lw in label_wrappers)
         by_ext = {}
         for ext in externals:
-            dist, lw = find_closest(ext.loc, label_wrappers)
+            dist, lw = label_grid.nearest(ext.loc)
             # log.debug(f"first level register {label_t.get_text().strip()} with dist={dist} {(ext.x, ext.y)} -> {loc}")
             by_ext[ext] = (lw.label, dist)
 
@@ -252,49 +278,54 @@ class PhyloMapAttempt(object):
         if (not unmatched_lvs) or (not unmatched_labels):
             return unmatched_labels
         matching_stats = MatchingStats(match_pairs, self)
-        sc_leaf_label = []
-
-        for leaf in unmatched_lvs:
-            sc_leaf_label.append(
-                self._find_best_match(leaf, unmatched_labels, matching_stats)
+        # heap of (score, leaf order, leaf, label) for the best label of each leaf.
+        #   An entry is stale once its label is matched to another leaf, and
+        #   it is rescored (against the remaining labels) when it is popped.
+        #   A leaf's best label among fewer labels can only score worse, so
+        #   the smallest fresh entry is always the best remaining pairing.
+        #   The leaf order is by location, as the order of a set of nodes
+        #   differs between runs and it breaks ties in the score.
+        heap = []
+        for n, leaf in enumerate(sorted(unmatched_lvs, key=lambda nd: nd.loc)):
+            score, leaf, label = self._find_best_match(
+                leaf, unmatched_labels, matching_stats
             )
-
-        while unmatched_labels and unmatched_lvs:
-            sc_leaf_label.sort()
-            best = sc_leaf_label.pop(0)
-            score, leaf, label = best
+            heap.append((score, n, leaf, label))
+        heapify(heap)
+        avail_labels = set(unmatched_labels)
+        while unmatched_labels and heap:
+            score, n, leaf, label = heap[0]
             if score > MAX_MATCHABLE_SCORE:
                 break
+            if label not in avail_labels:
+                score, leaf, label = self._find_best_match(
+                    leaf, unmatched_labels, matching_stats
+                )
+                heapreplace(heap, (score, n, leaf, label))
+                continue
+            heappop(heap)
             log.debug(f"Score matching: {score}, {leaf} <=> {label.get_text().strip()}")
 
             match_pairs.append((leaf, label))
             matched_labels.append(label)
             matched_leaves.add(leaf)
             unmatched_labels.remove(label)
+            avail_labels.remove(label)
             unmatched_lvs.remove(leaf)
             by_lab[label] = (leaf, None)
             by_ext[leaf] = (label, None)
-
-            # build list of indices in highest to lowest, to pop in the correct order below
-            idx_to_pop = []
-            for n, sc_lv_lab in enumerate(sc_leaf_label):
-                if label is sc_lv_lab[-1]:
-                    idx_to_pop.insert(0, n)
-            for idx in idx_to_pop:
-                sc_lv_lab = sc_leaf_label.pop(idx)
-                leaf = sc_lv_lab[1]
-                sc_leaf_label.append(
-                    self._find_best_match(leaf, unmatched_labels, matching_stats)
-                )
         return unmatched_labels
 
     def _find_best_match(self, leaf, unmatched_labels, matching_stats):
+        debugging = log.isEnabledFor(logging.DEBUG)
         min_score, min_score_label = float("inf"), None
         for label in unmatched_labels:
             score = matching_stats.score(leaf, label)
-            log.debug(f"Score of {score} for {leaf} <==> {label.get_text().strip()}")
+            if debugging:
+                log.debug(
+                    "Score of %s for %s <==> %s", score, leaf, label.get_text().strip()
+                )
             if score < min_score:
-                log.debug("New best")
                 min_score, min_score_label = score, label
         return min_score, leaf, min_score_label
 
@@ -324,9 +355,10 @@ class PhyloMapAttempt(object):
         mean_x_off, mean_y_off = mean_vector(offset_vec)
         log.debug(f"mean_offset = {(mean_x_off, mean_y_off)}")
 
+        lvs_grid = PointGrid.from_items((nd.loc, nd) for nd in unmatched_lvs)
         for label_t in unmatched_labels:
             loc = (calc_x(label_t) - mean_x_off, calc_y(label_t) - mean_y_off)
-            dist, ext = find_closest(loc, unmatched_lvs)
+            dist, ext = lvs_grid.nearest(loc)
             old = by_lab[label_t]
             if dist > 2 * old[1]:
                 # TODO make more generic. currently "not worse than twice as far..."
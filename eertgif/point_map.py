@@ -56,18 +56,27 @@ class PointMap:
             raise KeyError(pt)
         return val
 
+    def _find_key(self, pt):
+        if pt in self._items:
+            return pt
+        for jitter in self.jitters:
+            pt0 = self._rounded.get(self._round(pt, jitter))
+            if pt0 is not None:
+                return pt0
+        return None
+
     def __delitem__(self, pt):
         if not isinstance(pt, Pt):
             pt = Pt(float(pt))
-        if pt in self._items:
-            del self._items[pt]
-            return
+        key = self._find_key(pt)
+        if key is None:
+            raise KeyError(str(pt))
+        del self._items[key]
+        # drop the rounded aliases of key, so that later lookups do not find it
         for jitter in self.jitters:
-            pt_rnd = self._round(pt, jitter)
-            if pt_rnd in self._items:
-                del self._items[pt_rnd]
-                return
-        raise KeyError(str(pt))
+            pt_rnd = self._round(key, jitter)
+            if self._rounded.get(pt_rnd) == key:
+                del self._rounded[pt_rnd]
 
     def __setitem__(self, pt, val):
         if not isinstance(pt, Pt):
@@ -88,6 +97,9 @@ class PointMap:
     def __iter__(self):
         return iter(self._items)
 
+    def __len__(self):
+        return len(self._items)
+
     def items(self):
         return [(k.x, v) for k, v in self._items.items()]
 
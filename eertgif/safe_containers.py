@@ -2,6 +2,8 @@ from __future__ import annotations
 
 import logging
 import re
+from array import array
+from math import isnan
 from typing import Tuple, Optional
 
 from pdfminer.layout import (
@@ -13,6 +15,12 @@ from pdfminer.layout import (
 )
 from pdfminer.utils import Point
 from .point_map import PointMap
+
+try:
+    import numpy as np
+except ImportError:  # optional, shapes are diagnosed one curve at a time without it
+    np = None
+
 from .util import (
     AxisDir,
     DIM_TOL,
@@ -40,57 +48,294 @@ def safe_number(x):
     raise TypeError(f"Expected number got {type(x)} for {x}")
 
 
+# bits of CurveStore.flags
+_STROKE = 1
+_FILL = 2
+_EVENODD = 4
+_WAS_RECT = 8
+_INT_LINEWIDTH = 16
+_NAN = float("nan")
+
+
+class CurveStore(object):
+    """Columnar storage for the curves of a region (viewed as SafeCurve objects).
+
+    The points of curve `idx` are in xs and ys from pt_offsets[idx] up to
+    pt_offsets[idx + 1]. The other numbers for each curve are held in arrays
+    parallel to eertgif_ids (4 entries per curve for the bboxes and
+    eff_diagonals), and colors are indices into the `colors` palette.
+    This is much more compact (in memory and when pickled) than a Python
+    object with a list of point tuples for every curve.
+    """
+
+    def __init__(self):
+        self.xs = array("d")
+        self.ys = array("d")
+        self.pt_offsets = array("q", [0])
+        self.eertgif_ids = array("q")
+        self.bboxes = array("d")
+        self.linewidths = array("d")
+        self.flags = array("B")
+        self.stroking_colors = array("I")
+        self.non_stroking_colors = array("I")
+        self.colors = []
+        self._color_index = {}
+        # -1 and NaN until SafeCurve diagnoses the shape
+        self.shapes = array("b")
+        self.eff_diagonals = array("d")
+
+    def __len__(self):
+        return len(self.eertgif_ids)
+
+    def _color_to_idx(self, color):
+        key = tuple(color) if isinstance(color, list) else color
+        idx = self._color_index.get(key)
+        if idx is None:
+            idx = len(self.colors)
+            self.colors.append(color)
+            self._color_index[key] = idx
+        return idx
+
+    def add(
+        self,
+        eertgif_id,
+        bbox,
+        linewidth,
+        stroke,
+        fill,
+        evenodd,
+        was_rect,
+        stroking_color,
+        non_stroking_color,
+        pts,
+    ) -> int:
+        """Appends a curve, and returns its index."""
+        idx = len(self.eertgif_ids)
+        self.eertgif_ids.append(-1 if eertgif_id is None else eertgif_id)
+        self.bboxes.extend(bbox)
+        self.linewidths.append(linewidth)
+        flags = _INT_LINEWIDTH if isinstance(linewidth, int) else 0
+        for flag, val in (
+            (_STROKE, stroke),
+            (_FILL, fill),
+            (_EVENODD, evenodd),
+            (_WAS_RECT, was_rect),
+        ):
+            if val:
+                flags |= flag
+        self.flags.append(flags)
+        self.stroking_colors.append(self._color_to_idx(stroking_color))
+        self.non_stroking_colors.append(self._color_to_idx(non_stroking_color))
+        for x, y in pts:
+            self.xs.append(x)
+            self.ys.append(y)
+        self.pt_offsets.append(len(self.xs))
+        self.shapes.append(-1)
+        self.eff_diagonals.extend((_NAN, _NAN, _NAN, _NAN))
+        return idx
+
+    def pts(self, idx):
+        start, end = self.pt_offsets[idx], self.pt_offsets[idx + 1]
+        return list(zip(self.xs[start:end], self.ys[start:end]))
+
+    def num_pts(self, idx):
+        return self.pt_offsets[idx + 1] - self.pt_offsets[idx]
+
+    def bbox(self, idx):
+        return tuple(self.bboxes[4 * idx : 4 * idx + 4])
+
+    def has_flag(self, idx, flag):
+        return bool(self.flags[idx] & flag)
+
+    def linewidth(self, idx):
+        lw = self.linewidths[idx]
+        return int(lw) if self.flags[idx] & _INT_LINEWIDTH else lw
+
+    def shape(self, idx):
+        v = self.shapes[idx]
+        return None if v < 0 else CurveShape(v)
+
+    def set_shape(self, idx, shape):
+        self.shapes[idx] = -1 if shape is None else int(shape)
+
+    def eff_diagonal(self, idx):
+        v = self.eff_diagonals[4 * idx : 4 * idx + 4]
+        if isnan(v[0]):
+            return None
+        return (v[0], v[1]), (v[2], v[3])
+
+    def set_eff_diagonal(self, idx, eff_diagonal):
+        if eff_diagonal is None:
+            v = (_NAN, _NAN, _NAN, _NAN)
+        else:
+            (fx, fy), (sx, sy) = eff_diagonal
+            v = (fx, fy, sx, sy)
+        self.eff_diagonals[4 * idx : 4 * idx + 4] = array("d", v)
+
+    def __getstate__(self):
+        d = dict(self.__dict__)
+        del d["_color_index"]
+        return d
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._color_index = {}
+        for idx, color in enumerate(self.colors):
+            key = tuple(color) if isinstance(color, list) else color
+            self._color_index.setdefault(key, idx)
+
+
 class SafeCurve(object):
-    def __init__(self, lt_curve, eertgif_id):
-        self.eertgif_id = eertgif_id
-        self.x0 = safe_number(lt_curve.x0)
-        self.y0 = safe_number(lt_curve.y0)
-        self.x1 = safe_number(lt_curve.x1)
-        self.y1 = safe_number(lt_curve.y1)
-        self.width = safe_number(lt_curve.width)
-        self.height = safe_number(lt_curve.height)
+    """View of one curve in a CurveStore (safe for pickling).
+
+    If `store` is None, the curve gets a CurveStore of its own.
+    """
+
+    __slots__ = ("_store", "_idx")
+
+    def __init__(self, lt_curve, eertgif_id, store=None, diagnose=True):
         try:
-            self.linewidth = safe_number(lt_curve.linewidth)
+            linewidth = safe_number(lt_curve.linewidth)
         except:
-            self.linewidth = 1
-        self.stroke = bool(lt_curve.stroke)
-        self.fill = bool(lt_curve.fill)
-        self.evenodd = bool(lt_curve.evenodd)
-        self.was_rect = isinstance(lt_curve, LTRect)
-        if lt_curve.stroking_color is None:
-            self.stroking_color = None
-        else:
+            linewidth = 1
+        stroking_color = lt_curve.stroking_color
+        if stroking_color is not None:
             try:
-                self.stroking_color = [safe_number(i) for i in lt_curve.stroking_color]
+                stroking_color = [safe_number(i) for i in stroking_color]
             except:
-                self.stroking_color = safe_number(lt_curve.stroking_color)
-        if lt_curve.non_stroking_color is None:
-            self.non_stroking_color = None
-        else:
+                stroking_color = safe_number(stroking_color)
+        non_stroking_color = lt_curve.non_stroking_color
+        if non_stroking_color is not None:
             try:
-                self.non_stroking_color = [
-                    safe_number(i) for i in lt_curve.non_stroking_color
-                ]
+                non_stroking_color = [safe_number(i) for i in non_stroking_color]
             except:
-                self.non_stroking_color = safe_number(lt_curve.non_stroking_color)
-        self.pts = [(safe_number(x), safe_number(y)) for x, y in lt_curve.pts]
+                non_stroking_color = safe_number(non_stroking_color)
+        self._store = CurveStore() if store is None else store
+        self._idx = self._store.add(
+            eertgif_id=eertgif_id,
+            bbox=[
+                safe_number(i)
+                for i in (lt_curve.x0, lt_curve.y0, lt_curve.x1, lt_curve.y1)
+            ],
+            linewidth=linewidth,
+            stroke=bool(lt_curve.stroke),
+            fill=bool(lt_curve.fill),
+            evenodd=bool(lt_curve.evenodd),
+            was_rect=isinstance(lt_curve, LTRect),
+            stroking_color=stroking_color,
+            non_stroking_color=non_stroking_color,
+            pts=[(safe_number(x), safe_number(y)) for x, y in lt_curve.pts],
+        )
         # Note eff_diagonal (the effective) may contain bounding box points, any member of pts
-        self.shape, self.eff_diagonal = self._diagnose_shape()
+        if diagnose:
+            self.shape, self.eff_diagonal = self._diagnose_shape()
 
-    @property
-    def bbox(self):
-        return self.x0, self.y0, self.x1, self.y1
+    def __getstate__(self):
+        return self._store, self._idx
 
-    def _diagnose_shape(
-        self,
-        in_corner_tol: float = CORNER_TOL,
-        max_dim_non_line_like: float = BOX_TO_LINE_TOL,
-    ):
-        x = self._diagnose_shape(
-            in_corner_tol=in_corner_tol, max_dim_non_line_like=max_dim_non_line_like
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            self._set_legacy_state(state)
+        else:
+            self._store, self._idx = state
+
+    def _set_legacy_state(self, d):
+        """Loads a SafeCurve pickled before curves were held in a CurveStore."""
+        self._store = CurveStore()
+        self._idx = self._store.add(
+            eertgif_id=d["eertgif_id"],
+            bbox=(d["x0"], d["y0"], d["x1"], d["y1"]),
+            linewidth=d["linewidth"],
+            stroke=d["stroke"],
+            fill=d["fill"],
+            evenodd=d["evenodd"],
+            was_rect=d["was_rect"],
+            stroking_color=d["stroking_color"],
+            non_stroking_color=d["non_stroking_color"],
+            pts=d["pts"],
         )
-        self.shape, self.eff_diagonal = x
-        return self.shape
+        self.shape, self.eff_diagonal = d["shape"], d["eff_diagonal"]
+
+    @property
+    def eertgif_id(self):
+        i = self._store.eertgif_ids[self._idx]
+        return None if i < 0 else i
+
+    @property
+    def x0(self):
+        return self._store.bboxes[4 * self._idx]
+
+    @property
+    def y0(self):
+        return self._store.bboxes[4 * self._idx + 1]
+
+    @property
+    def x1(self):
+        return self._store.bboxes[4 * self._idx + 2]
+
+    @property
+    def y1(self):
+        return self._store.bboxes[4 * self._idx + 3]
+
+    @property
+    def width(self):
+        return self.x1 - self.x0
+
+    @property
+    def height(self):
+        return self.y1 - self.y0
+
+    @property
+    def linewidth(self):
+        return self._store.linewidth(self._idx)
+
+    @property
+    def stroke(self):
+        return self._store.has_flag(self._idx, _STROKE)
+
+    @property
+    def fill(self):
+        return self._store.has_flag(self._idx, _FILL)
+
+    @property
+    def evenodd(self):
+        return self._store.has_flag(self._idx, _EVENODD)
+
+    @property
+    def was_rect(self):
+        return self._store.has_flag(self._idx, _WAS_RECT)
+
+    @property
+    def stroking_color(self):
+        return self._store.colors[self._store.stroking_colors[self._idx]]
+
+    @property
+    def non_stroking_color(self):
+        return self._store.colors[self._store.non_stroking_colors[self._idx]]
+
+    @property
+    def pts(self):
+        return self._store.pts(self._idx)
+
+    @property
+    def shape(self):
+        return self._store.shape(self._idx)
+
+    @shape.setter
+    def shape(self, shape):
+        self._store.set_shape(self._idx, shape)
+
+    @property
+    def eff_diagonal(self):
+        return self._store.eff_diagonal(self._idx)
+
+    @eff_diagonal.setter
+    def eff_diagonal(self, eff_diagonal):
+        self._store.set_eff_diagonal(self._idx, eff_diagonal)
+
+    @property
+    def bbox(self):
+        return self._store.bbox(self._idx)
 
     def _diagnose_shape(
         self,
@@ -215,7 +460,7 @@ class SafeCurve(object):
             cc = next(iter(closest_corners))
             idx = corners_order.index(cc)
             cp = corners[idx]
-            return False, CurveShape.DOT, None, (cp, cp)
+            return False, CurveShape.DOT, (cp, cp)
         if len(closest_corners) == 3:
             if CurveShape.CORNER_LR not in closest_corners:
                 return True, CurveShape.CORNER_UL, (corners[0], corners[2])
@@ -452,14 +697,144 @@ def convert_to_safe_line(text_lines, eertgif_id, font_dict, pdf_interpret=None):
     return sl, eertgif_id
 
 
-def convert_to_safe_curves(curves, eertgif_id):
+def convert_to_safe_curves(curves, eertgif_id, store=None):
+    """Returns SafeCurve views for `curves` (all in one CurveStore) and the next id."""
+    if store is None:
+        store = CurveStore()
     sl = []
     for curve in curves:
-        sl.append(SafeCurve(curve, eertgif_id=eertgif_id))
+        sl.append(SafeCurve(curve, eertgif_id=eertgif_id, store=store, diagnose=False))
         eertgif_id += 1
+    diagnose_shapes(sl)
     return sl, eertgif_id
 
 
+def diagnose_shapes(
+    curves,
+    in_corner_tol: float = CORNER_TOL,
+    max_dim_non_line_like: float = BOX_TO_LINE_TOL,
+) -> None:
+    """Sets the shape and eff_diagonal of each SafeCurve in `curves`.
+
+    Same results as calling SafeCurve._diagnose_shape on each curve, but
+    if numpy is available the point-to-corner tests for a run of curves
+    that are consecutive in one CurveStore are done as array operations.
+    """
+    if np is not None and curves:
+        store, first = curves[0]._store, curves[0]._idx
+        if all(c._store is store and c._idx == first + n for n, c in enumerate(curves)):
+            _batch_diagnose_shapes(
+                curves, store, first, in_corner_tol, max_dim_non_line_like
+            )
+            return
+    for curve in curves:
+        curve.shape, curve.eff_diagonal = curve._diagnose_shape(
+            in_corner_tol=in_corner_tol, max_dim_non_line_like=max_dim_non_line_like
+        )
+
+
+# CurveShape of the corner-shaped curve for the 3-corner bit masks (bit n is
+#   corners_order[n]) and the indices of the corners for its eff_diagonal.
+_THREE_CORNER_SHAPES = {
+    0b0111: (CurveShape.CORNER_UL, 0, 2),
+    0b1011: (CurveShape.CORNER_LL, 1, 3),
+    0b1101: (CurveShape.CORNER_LR, 0, 2),
+    0b1110: (CurveShape.CORNER_UR, 1, 3),
+}
+# distances this close (relatively) to the tolerance or to each other could
+#   be ordered differently by the scalar calc_dist, so those curves use it.
+_REL_ULP_GUARD = 1e-12
+
+
+def _batch_diagnose_shapes(curves, store, first, in_corner_tol, max_dim):
+    num = len(curves)
+    offsets = np.frombuffer(store.pt_offsets, dtype=np.int64)[first : first + num + 1]
+    counts = np.diff(offsets)
+    pt_start, pt_end = int(offsets[0]), int(offsets[-1])
+    xs = np.frombuffer(store.xs, dtype=np.float64)[pt_start:pt_end]
+    ys = np.frombuffer(store.ys, dtype=np.float64)[pt_start:pt_end]
+    bb = np.frombuffer(store.bboxes, dtype=np.float64)[4 * first : 4 * (first + num)]
+    bb = bb.reshape(num, 4)
+    # corners in corners_order (see bbox_to_corners)
+    x0 = np.minimum(bb[:, 0], bb[:, 2])
+    x1 = np.maximum(bb[:, 0], bb[:, 2])
+    y0 = np.minimum(bb[:, 1], bb[:, 3])
+    y1 = np.maximum(bb[:, 1], bb[:, 3])
+    cx = np.stack((x0, x0, x1, x1), axis=1)
+    cy = np.stack((y0, y1, y1, y0), axis=1)
+
+    # distance from every point to the 4 corners of its curve's bbox
+    curve_of_pt = np.repeat(np.arange(num), counts)
+    dx = xs[:, None] - cx[curve_of_pt]
+    dy = ys[:, None] - cy[curve_of_pt]
+    dist = np.sqrt(dx * dx + dy * dy)
+    near = dist <= in_corner_tol
+    masked = np.where(near, dist, np.inf)
+    closest = np.argmin(masked, axis=1)
+    pt_near_any = near.any(axis=1)
+    # flag curves with a point whose result might differ from calc_dist's
+    guard = _REL_ULP_GUARD * max(in_corner_tol, 1.0)
+    ambiguous = (np.abs(dist - in_corner_tol) <= guard).any(axis=1)
+    srt = np.sort(masked, axis=1)
+    with np.errstate(invalid="ignore"):  # inf - inf when no corner is near
+        gap = srt[:, 1] - srt[:, 0]
+    ambiguous |= np.isfinite(srt[:, 1]) & (
+        gap <= _REL_ULP_GUARD * np.maximum(srt[:, 0], 1.0)
+    )
+
+    has_pts = counts > 0
+    starts = (offsets[:-1] - pt_start)[has_pts]
+    all_near = np.zeros(num, dtype=bool)
+    corner_bits = np.zeros(num, dtype=np.int64)
+    curve_ambiguous = np.zeros(num, dtype=bool)
+    if len(starts):
+        all_near[has_pts] = np.logical_and.reduceat(pt_near_any, starts)
+        bits = np.where(pt_near_any, np.left_shift(1, closest), 0)
+        corner_bits[has_pts] = np.bitwise_or.reduceat(bits, starts)
+        curve_ambiguous[has_pts] = np.logical_or.reduceat(ambiguous, starts)
+    width = bb[:, 2] - bb[:, 0]
+    height = bb[:, 3] - bb[:, 1]
+    small_dim = (width < max_dim) | (height < max_dim)
+
+    cx_l, cy_l = cx.tolist(), cy.tolist()
+    for n, curve in enumerate(curves):
+        count = counts[n]
+        if count < 3 or curve_ambiguous[n]:
+            curve.shape, curve.eff_diagonal = curve._diagnose_shape(
+                in_corner_tol=in_corner_tol, max_dim_non_line_like=max_dim
+            )
+            continue
+        shape, eff_diagonal = None, None
+        if all_near[n]:
+            mask = int(corner_bits[n])
+            corners = list(zip(cx_l[n], cy_l[n]))
+            if mask in _THREE_CORNER_SHAPES:
+                shape, fidx, sidx = _THREE_CORNER_SHAPES[mask]
+                eff_diagonal = (corners[fidx], corners[sidx])
+            elif mask == 0b1111:
+                if small_dim[n]:
+                    shape, eff_diagonal = (
+                        curve._find_eff_diagnonal_for_small_dim_line_like(
+                            curve.pts, corners
+                        )[1:]
+                    )
+            elif mask & (mask - 1) == 0:
+                cp = corners[mask.bit_length() - 1]
+                shape, eff_diagonal = CurveShape.DOT, (cp, cp)
+            else:
+                fidx = (mask & -mask).bit_length() - 1
+                sidx = mask.bit_length() - 1
+                shape = CurveShape.LINE_LIKE
+                eff_diagonal = (corners[fidx], corners[sidx])
+        if shape is None:
+            # not corner-shaped, or touches all 4 corners of a box that is not small
+            pts = curve.pts
+            shape, eff_diagonal = _diagnose_line_like_not_cornered(
+                pts, bbox_to_corners(curve.bbox)
+            )
+        curve.shape, curve.eff_diagonal = shape, eff_diagonal
+
+
 class UnprocessedRegion(object):
     def __init__(self, text_lines, nontext_objs, container, pdf_interpret=None):
         self.display_mode = DisplayMode.CURVES_AND_TEXT
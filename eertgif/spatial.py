@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import logging
+from bisect import bisect_left, bisect_right
+from math import floor, sqrt
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+
+from pdfminer.utils import Point, Rect
+from .util import calc_dist
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CELL_SIZE = 1.0
+
+
+class PointGrid(object):
+    """Uniform grid of items hashed by the cell that holds their location.
+
+    Each cell maps an insertion sequence number to (loc, item), so
+    callers can use the key returned by `insert` to remove an item in
+    constant time, and ties between equidistant items go to the item
+    that was inserted first.
+    """
+
+    def __init__(self, cell_size: float = DEFAULT_CELL_SIZE):
+        if not cell_size > 0:
+            cell_size = DEFAULT_CELL_SIZE
+        self.cell_size = float(cell_size)
+        self._cells = {}
+        self._next_seq = 0
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def _cell_for(self, x: float, y: float) -> Tuple[int, int]:
+        cs = self.cell_size
+        return floor(x / cs), floor(y / cs)
+
+    def insert(self, loc: Point, item: Any) -> Tuple[Tuple[int, int], int]:
+        """Adds `item` at `loc` and returns the key needed by `remove`."""
+        cell = self._cell_for(loc[0], loc[1])
+        seq = self._next_seq
+        self._next_seq += 1
+        self._cells.setdefault(cell, {})[seq] = (loc, item)
+        self._len += 1
+        return cell, seq
+
+    def remove(self, key: Tuple[Tuple[int, int], int]) -> Any:
+        """Removes and returns the item stored under `key` (from `insert`)."""
+        cell, seq = key
+        contents = self._cells[cell]
+        loc, item = contents.pop(seq)
+        if not contents:
+            del self._cells[cell]
+        self._len -= 1
+        return item
+
+    def _iter_near(self, loc: Point, radius: float) -> Iterator[Tuple[int, Point, Any]]:
+        """Yields (seq, loc, item) for every item in a cell within `radius` of `loc`.
+
+        The items are a superset of those within `radius`, in no
+        particular order.
+        """
+        x, y = loc
+        cs = self.cell_size
+        min_cx, max_cx = floor((x - radius) / cs), floor((x + radius) / cs)
+        min_cy, max_cy = floor((y - radius) / cs), floor((y + radius) / cs)
+        num_cells = (max_cx - min_cx + 1) * (max_cy - min_cy + 1)
+        if num_cells > len(self._cells):
+            # a large radius, it is cheaper to check every occupied cell
+            for (cx, cy), contents in self._cells.items():
+                if min_cx <= cx <= max_cx and min_cy <= cy <= max_cy:
+                    for seq, loc_item in contents.items():
+                        yield seq, loc_item[0], loc_item[1]
+            return
+        cells = self._cells
+        for cx in range(min_cx, max_cx + 1):
+            for cy in range(min_cy, max_cy + 1):
+                contents = cells.get((cx, cy))
+                if contents:
+                    for seq, loc_item in contents.items():
+                        yield seq, loc_item[0], loc_item[1]
+
+    @classmethod
+    def from_items(cls, loc_items: Iterable[Tuple[Point, Any]]) -> PointGrid:
+        """Returns a grid of the (loc, item) pairs with cells sized for about 1 item each.
+
+        Items are inserted in order, so ties in `nearest` go to the earliest.
+        """
+        loc_items = list(loc_items)
+        cell_size = DEFAULT_CELL_SIZE
+        if len(loc_items) > 1:
+            xs = [li[0][0] for li in loc_items]
+            ys = [li[0][1] for li in loc_items]
+            width, height = max(xs) - min(xs), max(ys) - min(ys)
+            # the area-based size is 0 when the items are in a row (e.g. tips)
+            n = len(loc_items)
+            size = max(sqrt(width * height / n), max(width, height) / n)
+            if size > 0:
+                cell_size = size
+        grid = cls(cell_size)
+        for loc, item in loc_items:
+            grid.insert(loc, item)
+        return grid
+
+    def nearest(
+        self, loc: Point, max_dist: Optional[float] = None
+    ) -> Tuple[float, Optional[Any]]:
+        """Returns (dist, item) for the closest item strictly within `max_dist` of `loc`.
+
+        Returns (max_dist, None) if no item is that close. If `max_dist` is
+        None, the search widens until an item is found (like util.find_closest),
+        and (inf, None) is returned for an empty grid.
+        """
+        if max_dist is not None:
+            return self._nearest_within(loc, max_dist)
+        if not self._len:
+            return float("inf"), None
+        radius = self.cell_size
+        while True:
+            # every item closer than radius is visited, so the first hit is the closest
+            dist, item = self._nearest_within(loc, radius)
+            if item is not None:
+                return dist, item
+            radius *= 2.0
+
+    def _nearest_within(
+        self, loc: Point, max_dist: float
+    ) -> Tuple[float, Optional[Any]]:
+        best_dist, best_seq, best_item = max_dist, None, None
+        for seq, el_loc, item in self._iter_near(loc, max_dist):
+            d = calc_dist(loc, el_loc)
+            if d < best_dist or (
+                d == best_dist and best_seq is not None and seq < best_seq
+            ):
+                best_dist, best_seq, best_item = d, seq, item
+        return best_dist, best_item
+
+
+class CoordIndex(object):
+    """Static index of items by a single coordinate, queried with bisect."""
+
+    def __init__(self, coord_items: Iterable[Tuple[float, Any]]):
+        by_coord = sorted(coord_items, key=lambda ci: ci[0])
+        self._coords = [ci[0] for ci in by_coord]
+        self._items = [ci[1] for ci in by_coord]
+
+    def __len__(self):
+        return len(self._coords)
+
+    def within(self, coord: float, tol: float) -> List[Any]:
+        """Returns the items whose coordinate is within `tol` of `coord` (inclusive)."""
+        lo = bisect_left(self._coords, coord - tol)
+        hi = bisect_right(self._coords, coord + tol)
+        return self._items[lo:hi]
+
+
+class BoxIndex(object):
+    """Static index of items by bounding box, for finding those that overlap a rect.
+
+    Each item is listed in every cell of a uniform grid that its bbox
+    touches. The cells default to the mean of the larger dimension of
+    the boxes, so a typical box is in a few cells.
+    """
+
+    def __init__(self, rect_items: Iterable[Tuple[Rect, Any]], cell_size: float = None):
+        rect_items = list(rect_items)
+        self._rects = [ri[0] for ri in rect_items]
+        self._items = [ri[1] for ri in rect_items]
+        if cell_size is None and self._rects:
+            dims = [max(r[2] - r[0], r[3] - r[1]) for r in self._rects]
+            cell_size = sum(dims) / len(dims)
+        if not (cell_size and cell_size > 0):
+            cell_size = DEFAULT_CELL_SIZE
+        self.cell_size = float(cell_size)
+        self._cells = {}
+        for seq, rect in enumerate(self._rects):
+            min_cx, min_cy, max_cx, max_cy = self._cell_range(rect)
+            for cx in range(min_cx, max_cx + 1):
+                for cy in range(min_cy, max_cy + 1):
+                    self._cells.setdefault((cx, cy), []).append(seq)
+
+    def __len__(self):
+        return len(self._items)
+
+    def _cell_range(self, rect: Rect) -> Tuple[int, int, int, int]:
+        cs = self.cell_size
+        x0, y0, x1, y1 = rect
+        return floor(x0 / cs), floor(y0 / cs), floor(x1 / cs), floor(y1 / cs)
+
+    def overlapping(self, rect: Rect) -> List[Any]:
+        """Returns the items whose bbox overlaps `rect` (edges included), in index order."""
+        if not self._items:
+            return []
+        min_cx, min_cy, max_cx, max_cy = self._cell_range(rect)
+        num_cells = (max_cx - min_cx + 1) * (max_cy - min_cy + 1)
+        candidates = set()
+        if num_cells > len(self._cells):
+            for (cx, cy), seqs in self._cells.items():
+                if min_cx <= cx <= max_cx and min_cy <= cy <= max_cy:
+                    candidates.update(seqs)
+        else:
+            cells = self._cells
+            for cx in range(min_cx, max_cx + 1):
+                for cy in range(min_cy, max_cy + 1):
+                    seqs = cells.get((cx, cy))
+                    if seqs:
+                        candidates.update(seqs)
+        x0, y0, x1, y1 = rect
+        found = []
+        for seq in sorted(candidates):
+            lx0, ly0, lx1, ly1 = self._rects[seq]
+            if lx0 <= x1 and lx1 >= x0 and ly0 <= y1 and ly1 >= y0:
+                found.append(self._items[seq])
+        return found
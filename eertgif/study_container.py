@@ -29,6 +29,7 @@ class StudyContainer(object):
         self.par_dir = par_dir
         self._page_ids = None
         self._image_ids = None
+        self._num_file_paths = None
         self._page_status_list = []
         self._page_status_list = self.blob.setdefault(
             "page_status_list", self.page_status_list
@@ -45,24 +46,41 @@ class StudyContainer(object):
 
     @property
     def page_ids(self):
-        if self._page_ids is None:
+        # regions are appended to "unprocessed" while an upload is being parsed,
+        #   so the cached ids are extended when the list grows.
+        pn = self.pickles_names
+        if self._page_ids is None or len(self._page_ids) != len(pn):
             lensuf = len(".pickle")
-            self._page_ids = [i[:-lensuf] for i in self.pickles_names]
+            self._page_ids = [i[:-lensuf] for i in pn]
             # TODO page status diagnosis?
             npi = len(self._page_ids)
-            if not self._page_status_list:
-                x = [RegionStatus.UNKNOWN] * npi
-                self._page_status_list[:] = x
-            self._obj_for_regions = [None] * npi
+            psl = self._page_status_list
+            if len(psl) < npi:
+                psl.extend([RegionStatus.UNKNOWN] * (npi - len(psl)))
+            if self._obj_for_regions is None:
+                self._obj_for_regions = []
+            ofr = self._obj_for_regions
+            ofr.extend([None] * (npi - len(ofr)))
         return self._page_ids
 
+    @property
+    def image_refs(self):
+        """List of images that were recorded, but not exported, at upload (see LazyImageWriter)."""
+        return self.blob.get("image_refs", [])
+
     @property
     def image_ids(self):
-        if self._image_ids is None:
+        afp, refs = self.all_file_paths, self.image_refs
+        if self._image_ids is None or self._num_file_paths != (len(afp), len(refs)):
             ipath = f"{os.sep}img{os.sep}"
+            lazy_files = set(i["file"] for i in refs if "file" in i)
             self._image_ids = [
-                os.path.split(i)[-1] for i in self.all_file_paths if ipath in i
+                os.path.split(i)[-1]
+                for i in afp
+                if ipath in i and os.path.split(i)[-1] not in lazy_files
             ]
+            self._image_ids.extend([i["id"] for i in refs])
+            self._num_file_paths = (len(afp), len(refs))
         return self._image_ids
 
     @property
@@ -94,7 +112,19 @@ class StudyContainer(object):
     def set_object_for_region(self, idx, obj):
         self._obj_for_regions[idx] = obj
 
+    def image_ref(self, img_id) -> Optional[dict]:
+        for i in self.image_refs:
+            if i["id"] == img_id:
+                return i
+        return None
+
     def path_to_image(self, img_id) -> Optional[str]:
+        """Returns the path to the image file, or None if the image has not been exported."""
+        ref = self.image_ref(img_id)
+        if ref is not None:
+            img_id = ref.get("file")
+            if img_id is None:
+                return None
         suffix = f"{os.sep}img{os.sep}{img_id}"
         for i in self.all_file_paths:
             if i.endswith(suffix):
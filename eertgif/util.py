@@ -4,9 +4,10 @@ from __future__ import annotations
 import logging
 from enum import IntEnum
 from math import sqrt
-from typing import List, Any, Tuple, Union, Iterable
+from typing import List, Any, Tuple, Union, Iterable, Optional, Set
 import re
 import os
+import shutil
 import time
 from threading import Thread
 from pdfminer.utils import Point, Rect
@@ -200,6 +201,32 @@ def as_numeric(label):
     return False, None
 
 
+_page_range_pat = re.compile(r"^(\d+)(?:-(\d+))?$")
+
+
+def parse_page_ranges(s: str) -> Optional[Set[int]]:
+    """Parses page ranges such as "3-5,47" into a set of 0-based page indices.
+
+    Page numbers in `s` are 1-based (as printed by a pdf viewer).
+    Returns None for an empty string (meaning all pages).
+    Raises ValueError for malformed ranges.
+    """
+    if s is None or not s.strip():
+        return None
+    pages = set()
+    for word in s.split(","):
+        word = "".join(word.split())
+        m = _page_range_pat.match(word)
+        if not m:
+            raise ValueError(f'"{word}" is not a page number or range of pages')
+        first = int(m.group(1))
+        last = first if m.group(2) is None else int(m.group(2))
+        if first < 1 or last < first:
+            raise ValueError(f'"{word}" is not a valid range of pages')
+        pages.update(range(first - 1, last))
+    return pages
+
+
 def bbox_to_corners(bbox: Rect) -> Tuple[Tuple[Point, Point]]:
     """Bounding box to 4 pairs of coordinates.
     assuming min x = left, and min y = Down
@@ -334,6 +361,86 @@ class ExtractionConfig(object):
         setattr(self, key, val)
 
 
+class IdOrderedSubset(object):
+    """Subset of a fixed sequence of objects, keyed by their eertgif_id.
+
+    Membership changes are constant time, and iteration yields the members
+    in the order of the original sequence. Subsets created by `empty_like`
+    share the ordering of the same sequence.
+    """
+
+    def __init__(self, universe=None, members=(), rank=None):
+        if rank is None:
+            rank = {o.eertgif_id: n for n, o in enumerate(universe or ())}
+        self._rank = rank
+        self._by_id = {}
+        self._ordered = None
+        for obj in members:
+            self.add(obj)
+
+    def empty_like(self) -> IdOrderedSubset:
+        return IdOrderedSubset(rank=self._rank)
+
+    def _in_order(self) -> list:
+        if self._ordered is None:
+            rank = self._rank
+            self._ordered = sorted(
+                self._by_id.values(), key=lambda o: rank[o.eertgif_id]
+            )
+        return self._ordered
+
+    def __iter__(self):
+        return iter(self._in_order())
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __getitem__(self, idx):
+        return self._in_order()[idx]
+
+    def __contains__(self, obj):
+        return self._by_id.get(getattr(obj, "eertgif_id", None)) is obj
+
+    def ids(self):
+        return self._by_id.keys()
+
+    def get(self, eertgif_id, default=None):
+        return self._by_id.get(eertgif_id, default)
+
+    def add(self, obj) -> None:
+        if obj.eertgif_id not in self._by_id:
+            self._by_id[obj.eertgif_id] = obj
+            self._ordered = None
+
+    def discard(self, obj) -> None:
+        if self._by_id.pop(obj.eertgif_id, None) is not None:
+            self._ordered = None
+
+    def set_members(self, objs) -> bool:
+        """Makes `objs` the members, returns True if that changed the subset."""
+        by_id = {o.eertgif_id: o for o in objs}
+        if by_id.keys() == self._by_id.keys():
+            return False
+        self._by_id = by_id
+        self._ordered = None
+        return True
+
+
+def set_slots_state(obj, state) -> None:
+    """__setstate__ for classes with __slots__.
+
+    Also accepts the __dict__ of objects that were pickled before their class
+    declared __slots__.
+    """
+    if isinstance(state, tuple):
+        d = dict(state[0] or {})
+        d.update(state[1] or {})
+    else:
+        d = state
+    for k, v in d.items():
+        setattr(obj, k, v)
+
+
 def sleep_til_can_remove(fp):
     sleep_duration = 1
     while os.path.exists(fp):
@@ -6,6 +6,7 @@ import pickle
 import re
 import shutil
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from threading import Lock
 
 from pyramid.httpexceptions import HTTPConflict, HTTPBadRequest, HTTPFound, HTTPNotFound
@@ -13,9 +14,24 @@ from pyramid.view import view_config
 from pyramid.response import FileResponse
 
 from pdfminer.image import ImageWriter
-from .extract import get_regions_unprocessed, UnprocessedRegion, ExtractionManager
+from .extract import (
+    count_pages,
+    export_image_ref,
+    LazyImageWriter,
+    iter_regions_unprocessed,
+    ingest_settings,
+    UnprocessedRegion,
+    ExtractionManager,
+)
+from .ingest_cache import IngestCache, CACHE_DIR_NAME, DEFAULT_MAX_BYTES
 from .study_container import StudyContainer, RegionStatus
-from .util import win_safe_remove, win_safe_rename, next_uniq_fp, DisplayMode
+from .util import (
+    win_safe_remove,
+    win_safe_rename,
+    next_uniq_fp,
+    DisplayMode,
+    parse_page_ranges,
+)
 
 
 log = logging.getLogger("eertgif")
@@ -33,6 +49,12 @@ _uploads_by_tag = {}
 _upload_lock = Lock()
 _up_dir = None
 
+# uploads are parsed by UploadJob objects run in _upload_executor.
+#   _upload_jobs maps the tag of a study to its UploadJob until the
+#   job is finished. Both are guarded by _upload_lock
+_upload_executor = None
+_upload_jobs = {}
+
 _info_fn = "info.json"
 _tag_pat = re.compile(r"^[ a-zA-Z0-9]+$")
 
@@ -99,6 +121,234 @@ def scan_for_uploads(uploads_dir):
     return u, bt
 
 
+class UploadStatus:
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    # queued or running when the server stopped
+    INTERRUPTED = "interrupted"
+
+    active = frozenset([QUEUED, RUNNING])
+
+
+def upload_status(tag, blob):
+    """Returns the UploadStatus of a study. Caller must hold the study lock."""
+    status = blob.get("status", UploadStatus.DONE)
+    if status in UploadStatus.active:
+        with _upload_lock:
+            if tag not in _upload_jobs:
+                return UploadStatus.INTERRUPTED
+    return status
+
+
+class _UploadCancelled(Exception):
+    """Raised by the progress callback of an UploadJob to stop a cancelled parse."""
+
+
+class UploadJob(object):
+    """Parses an uploaded pdf in a thread of _upload_executor.
+
+    The study lock is only held while the results for a region (or the
+    progress for a page) are recorded in the study's blob, so views of the
+    study can show the regions found so far.
+    """
+
+    def __init__(self, tag, shared_list, filename, page_numbers, num_workers, cache):
+        self.tag = tag
+        self.shared_list = shared_list
+        self.filename = filename
+        self.page_numbers = page_numbers
+        self.num_workers = num_workers
+        self.cache = cache
+        self.future = None
+        self.cancelled = False
+        self.finished = False
+        self.error_msg = f'Uploaded "{filename}" could not be processed as a pdf file'
+        self.image_paths = []
+        self.image_writer = LazyImageWriter(os.path.join(shared_list[1], "img"))
+        self._num_imgs_recorded = 0
+
+    def cancel(self):
+        """Caller must hold the study lock.
+
+        Returns True if the job is running and will clean up the files of the study.
+        """
+        if self.finished:
+            return False
+        if self.future is not None and self.future.cancel():
+            self.finished = True
+            return False
+        self.cancelled = True
+        return True
+
+    def run(self):
+        try:
+            self._run()
+        except:
+            log.exception(f'parse of upload "{self.tag}" failed')
+            with self.shared_list[2]:
+                self._finish_lock_held(UploadStatus.FAILED, self.image_paths)
+        finally:
+            with _upload_lock:
+                if _upload_jobs.get(self.tag) is self:
+                    del _upload_jobs[self.tag]
+
+    def _record_images_lock_held(self, image_paths):
+        """Adds exported images to "to_clean" and recorded ones to "image_refs"."""
+        blob, dest_dir = self.shared_list[:2]
+        new_imgs = image_paths[self._num_imgs_recorded :]
+        img_dir = os.path.join(dest_dir, "img")
+        refs = self.image_writer.image_refs
+        blob_refs = blob.setdefault("image_refs", [])
+        recorded = set(i["id"] for i in blob_refs)
+        for name in new_imgs:
+            ref = refs.get(name)
+            if ref is None:
+                blob["to_clean"].append(os.path.join(img_dir, name))
+            elif name not in recorded:
+                blob_refs.append(dict(ref, id=name))
+                recorded.add(name)
+        self._num_imgs_recorded += len(new_imgs)
+
+    def _finish_lock_held(self, status, image_paths):
+        blob, dest_dir = self.shared_list[:2]
+        self._record_images_lock_held(image_paths)
+        self.finished = True
+        if self.cancelled:
+            log.debug(f'cleaning up cancelled upload "{self.tag}"')
+            clean_files_and_dir_no_raise(blob.get("to_clean", []), dest_dir)
+            # in case a rescan found the study before it was cancelled. A
+            #   new study may have the tag by now, so only this dir is removed.
+            force_remove_study_from_upload_globals(self.tag, dest_dir)
+            return
+        blob["status"] = status
+        if status == UploadStatus.FAILED:
+            blob["error"] = self.error_msg
+        _serialize_info_blob_unlocked(blob, dest_dir)
+
+    def _run(self):
+        blob, dest_dir, study_lock = self.shared_list[:3]
+        file_path = os.path.join(dest_dir, "uploaded.pdf")
+        with study_lock:
+            if self.cancelled:
+                self._finish_lock_held(None, [])
+                return
+            blob["status"] = UploadStatus.RUNNING
+            _serialize_info_blob_unlocked(blob, dest_dir)
+
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.key_for(
+                file_path, ingest_settings(page_numbers=self.page_numbers)
+            )
+            with study_lock:
+                if self.cancelled:
+                    self._finish_lock_held(None, [])
+                    return
+                cached = self.cache.restore(cache_key, dest_dir)
+                if cached is not None:
+                    blob["to_clean"].extend(
+                        [os.path.join(dest_dir, i) for i in cached["unprocessed"]]
+                    )
+                    blob["unprocessed"].extend(cached["unprocessed"])
+                    blob["page_scans"] = cached["page_scans"]
+                    blob["image_refs"] = cached["image_refs"]
+                    self._finish_lock_held(UploadStatus.DONE, cached["images"])
+                    return
+
+        page_list = range(count_pages(file_path))
+        if self.page_numbers:
+            page_list = [i for i in page_list if i in self.page_numbers]
+        with study_lock:
+            if self.cancelled:
+                self._finish_lock_held(None, [])
+                return
+            progress_blob = {"pages_done": 0, "num_pages": len(page_list)}
+            blob["progress"] = progress_blob
+            _serialize_info_blob_unlocked(blob, dest_dir)
+
+        image_paths, page_scans = self.image_paths, []
+
+        def page_done(page_num):
+            with study_lock:
+                if self.cancelled:
+                    raise _UploadCancelled()
+                progress_blob["pages_done"] += 1
+                self._record_images_lock_held(image_paths)
+                _serialize_info_blob_unlocked(blob, dest_dir)
+
+        regions = iter_regions_unprocessed(
+            file_path,
+            image_writer=self.image_writer,
+            num_workers=self.num_workers,
+            image_paths=image_paths,
+            page_scans=page_scans,
+            page_numbers=self.page_numbers,
+            progress=page_done,
+        )
+        nfs = set()
+        try:
+            # each region is pickled as soon as it is parsed, so that the
+            #   layout of the whole pdf is never held in memory.
+            for ur in regions:
+                with study_lock:
+                    if self.cancelled:
+                        break
+                    pf = f"{ur.tag}.pickle"
+                    if pf in nfs:
+                        log.error(f"{pf} already pickled")
+                        assert False
+                    nfs.add(pf)
+                    pfp = os.path.join(dest_dir, pf)
+                    blob["to_clean"].append(pfp)
+                    try:
+                        with open(pfp, "wb") as f_out:
+                            pickle.dump(ur, f_out, protocol=pickle.HIGHEST_PROTOCOL)
+                    except TypeError:
+                        self.error_msg = (
+                            "Unexpected error in storing segments of uploaded file."
+                        )
+                        raise
+                    blob["unprocessed"].append(pf)
+                    self._record_images_lock_held(image_paths)
+                    _serialize_info_blob_unlocked(blob, dest_dir)
+        except _UploadCancelled:
+            pass
+        finally:
+            regions.close()
+        with study_lock:
+            if not self.cancelled:
+                blob["page_scans"] = [i.as_dict() for i in page_scans]
+            self._finish_lock_held(UploadStatus.DONE, image_paths)
+            if self.cancelled:
+                return
+            refs = self.image_writer.image_refs
+            manifest = {
+                "unprocessed": list(blob["unprocessed"]),
+                "images": [i for i in image_paths if i not in refs],
+                "image_refs": [
+                    {k: v for k, v in i.items() if k != "file"}
+                    for i in blob["image_refs"]
+                ],
+                "page_scans": blob["page_scans"],
+            }
+        if self.cache is not None:
+            self.cache.store(cache_key, dest_dir, manifest)
+
+
+def _submit_upload_job(job, max_workers):
+    """Queues `job` on _upload_executor (created with `max_workers` threads on first use)."""
+    global _upload_executor
+    with _upload_lock:
+        if _upload_executor is None:
+            _upload_executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="eertgif-upload"
+            )
+        _upload_jobs[job.tag] = job
+        job.future = _upload_executor.submit(job.run)
+
+
 class ExtractActions:
     DETECT_COMPONENT = "detect_components"
     EXTRACT_TREES = "extract_trees"
@@ -118,6 +368,20 @@ class EertgifView:
         settings = self.request.registry.settings
         self.uploads_dir = settings.get("uploads.dir", "scratch")
         self.debug_mode = settings.get("debug_mode", False)
+        self.ingest_workers = int(settings.get("ingest.workers", 1))
+        self.upload_workers = int(settings.get("upload.workers", 2))
+        self.ingest_cache_max_bytes = int(
+            settings.get("ingest_cache.max_bytes", DEFAULT_MAX_BYTES)
+        )
+
+    def _ingest_cache(self):
+        """Returns the IngestCache for the uploads dir, or None if caching is disabled."""
+        if self.ingest_cache_max_bytes <= 0:
+            return None
+        return IngestCache(
+            os.path.join(self.uploads_dir, CACHE_DIR_NAME),
+            max_bytes=self.ingest_cache_max_bytes,
+        )
 
     def _uploads(self):
         """Returns a list of a shallow copy of _uploads, and _uploads_by_tag"""
@@ -200,6 +464,22 @@ class EertgifView:
             top_cont.page_status_list[idx] = validated_stat
         return HTTPFound(f"/view/{tag}?page={page_id}")
 
+    @view_config(route_name="eertgif:progress", renderer="json")
+    def progress_view(self):
+        tag = self.request.matchdict["tag"]
+        shared_list = self._get_shared_list_for_upload(tag)
+        info_blob, tmp_dir, study_lock, top_cont = shared_list
+        with study_lock:
+            d = {
+                "tag": tag,
+                "status": upload_status(tag, info_blob),
+                "num_regions": len(info_blob.get("unprocessed", [])),
+            }
+            d.update(info_blob.get("progress", {}))
+            if "error" in info_blob:
+                d["error"] = info_blob["error"]
+        return d
+
     @view_config(route_name="eertgif:get_tree", request_method="GET")
     def get_tree_view(self):
         tag, page_id = self._get_tag_and_mandatory_page_id()
@@ -239,6 +519,19 @@ class EertgifView:
             top_cont.blob.setdefault("to_clean", []).extend(fn_list)
             _serialize_info_blob_unlocked(top_cont.blob, top_cont.par_dir)
 
+    def _export_image_ref(self, img_ref, top_cont):
+        """Writes an image that was only recorded at upload (by LazyImageWriter).
+
+        Returns the path to the image. Assumes caller has study_lock, but NOT _upload_lock !
+        """
+        pd = top_cont.par_dir
+        iw = ImageWriter(os.path.join(pd, "img"))
+        fn = export_image_ref(os.path.join(pd, "uploaded.pdf"), img_ref, iw)
+        img_ref["file"] = fn
+        fp = os.path.join(pd, "img", fn)
+        self._add_to_to_clean([fp], top_cont)
+        return fp
+
     def _convert_obj_to_em(self, obj_for_region, page_id, idx, top_cont):
         """Assumes caller has study_lock, but NOT _upload_lock !"""
         em = ExtractionManager(obj_for_region)
@@ -387,6 +680,9 @@ class EertgifView:
             pages = list(top_cont.page_ids)
             images = list(top_cont.image_ids)
             page_status = list(top_cont.page_status_list)
+            up_status = upload_status(tag, top_cont.blob)
+            progress = dict(top_cont.blob.get("progress", {}))
+            error = top_cont.blob.get("error")
         pages = [(i, page_status[n]) for n, i in enumerate(pages)]
         single_item = False
         next_region_id = None
@@ -435,6 +731,9 @@ class EertgifView:
             "prev_region_id": prev_region_id,
             "svg": svg,
             "status": status,
+            "upload_status": up_status,
+            "progress": progress,
+            "error": error,
         }
         return d
 
@@ -450,6 +749,16 @@ class EertgifView:
         study_lock, top_cont = self._get_lock_and_top(tag)
         with study_lock:
             path_to_image = top_cont.path_to_image(img_id)
+            if path_to_image is None:
+                img_ref = top_cont.image_ref(img_id)
+                if img_ref is not None:
+                    try:
+                        path_to_image = self._export_image_ref(img_ref, top_cont)
+                    except:
+                        log.exception(f"export of image {img_id} failed")
+                        return HTTPConflict(
+                            f"Server-side image {img_id} in {tag} could not be exported."
+                        )
         if path_to_image is None:
             return HTTPNotFound(f"Image {img_id} in {tag} does not exist.")
         try:
@@ -459,7 +768,7 @@ class EertgifView:
             return HTTPConflict(
                 "Server-side mage {img_id} in {tag} does not is not parsable."
             )
-        ext = img_id.split(".")[-1]
+        ext = path_to_image.split(".")[-1]
         resp = self.request.response
         resp.content_type = f"image/{ext}"
         resp.body = image_blob
@@ -472,6 +781,15 @@ class EertgifView:
         info_blob, tmp_dir, study_lock, top_cont = shared_list
         log.debug(f"shared_list = {shared_list}")
         with study_lock:
+            with _upload_lock:
+                job = _upload_jobs.pop(tag, None)
+            if job is not None and job.cancel():
+                # the job removes the other files when it notices the
+                #   cancellation. Without its info blob, a rescan of the
+                #   uploads dir does not find the study in the meantime.
+                win_safe_remove(os.path.join(tmp_dir, _info_fn))
+                force_remove_study_from_upload_globals(tag)
+                return HTTPFound(location="/")
             tc = info_blob.get("to_clean", [])
             if not clean_files_and_dir_no_raise(tc, tmp_dir):
                 log.info(f"Failed to remove {tmp_dir}")
@@ -494,6 +812,11 @@ class EertgifView:
             return HTTPBadRequest(
                 f'"{tag}" is already in use. Choose a new name, or delete the existing study with that name'
             )
+        pages = self.request.POST.get("pages", "").strip()
+        try:
+            page_numbers = parse_page_ranges(pages)
+        except ValueError as x:
+            return HTTPBadRequest(f'"{pages}" is not a valid list of pages: {x}')
         dest_dir = tempfile.mkdtemp(dir=self.uploads_dir)
         shared_list = force_add_upload_dir(tag, dest_dir)
         blob, tmp_dir, study_lock, top_cont = shared_list
@@ -503,6 +826,8 @@ class EertgifView:
             to_clean = []
             blob["tag"] = tag
             blob["to_clean"] = to_clean
+            if page_numbers:
+                blob["pages"] = pages
             to_clean.append(_serialize_info_blob_unlocked(blob, dest_dir))
 
             filename = self.request.POST["pdf"].filename
@@ -521,56 +846,34 @@ class EertgifView:
             to_clean.append(file_path)
 
             img_dir = os.path.join(dest_dir, "img")
-            iw = ImageWriter(img_dir)
+            os.makedirs(img_dir)
             to_clean.append(img_dir)
-
-            try:
-                unproc_regions, image_paths = get_regions_unprocessed(
-                    file_path, image_writer=iw
-                )
-                to_clean.extend([os.path.join(img_dir, i) for i in image_paths])
-            except:
-                log.exception(f"pdf parse failure")
-                clean_files_and_dir_no_raise(to_clean, dest_dir)
-                force_remove_study_from_upload_globals(tag)
-                return HTTPBadRequest(
-                    f'Uploaded "{filename}" could not be processed as a pdf file'
-                )
-            try:
-                pickled = []
-                nfs = set()
-                for ur in unproc_regions:
-                    pf = f"{ur.tag}.pickle"
-                    if pf in nfs:
-                        log.error(f"{pf} already pickled")
-                        assert False
-                    nfs.add(pf)
-                    pfp = os.path.join(dest_dir, pf)
-                    to_clean.append(pfp)
-                    with open(pfp, "wb") as f_out:
-                        pickle.dump(ur, f_out, protocol=pickle.HIGHEST_PROTOCOL)
-                    pickled.append(pf)
-            except TypeError:
-                log.exception(f"Pickle failure")
-                clean_files_and_dir_no_raise(to_clean, dest_dir)
-                force_remove_study_from_upload_globals(tag)
-                return HTTPBadRequest(
-                    f"Unexpected error in storing segments of uploaded file."
-                )
-            blob["unprocessed"] = pickled
+            blob["unprocessed"] = []
+            blob["status"] = UploadStatus.QUEUED
             _serialize_info_blob_unlocked(blob, dest_dir)
+            job = UploadJob(
+                tag,
+                shared_list,
+                filename,
+                page_numbers,
+                self.ingest_workers,
+                self._ingest_cache(),
+            )
+            _submit_upload_job(job, self.upload_workers)
         return HTTPFound(location=f"/view/{tag}")
 
 
-def force_remove_study_from_upload_globals(tag):
+def force_remove_study_from_upload_globals(tag, dest_dir=None):
+    """Removes the study `tag`, or only its entries in `dest_dir` if that is given."""
     log.debug(f'force removing "{tag}"')
     with _upload_lock:
-        if tag in _uploads_by_tag:
+        prev = _uploads_by_tag.get(tag)
+        if prev is not None and (dest_dir is None or prev[1] == dest_dir):
             log.debug(f'force removing "{tag}" from _uploads_by_tag')
             del _uploads_by_tag[tag]
         to_pop = None
         for n, u in enumerate(_uploads):
-            if u[0] == tag:
+            if u[0] == tag and (dest_dir is None or u[1][1] == dest_dir):
                 to_pop = n
                 break
         if to_pop is not None:
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 import sys
-from eertgif.extract import main
+from eertgif.extract import main, parse_cli_args
 
 import logging
 
@@ -18,4 +18,13 @@ for logger in loggers:
 
 
 if __name__ == "__main__":
-    sys.exit(main(sys.argv[1], sys.argv[-1], "images"))
+    args = parse_cli_args()
+    sys.exit(
+        main(
+            args.input,
+            args.config,
+            "images",
+            num_workers=args.workers,
+            page_numbers=args.pages,
+        )
+    )